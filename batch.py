@@ -2,34 +2,89 @@ import numpy as np
 import time
 import sys
 import os, shlex
-import utilix
-from utilix.batchq import *
+import json
+import subprocess
 import pickle
+import heapq
+import shutil
 import configparser
-from utilix.io import load_runlist
-
-try:
-    _, run_mode, load_peaks, load_events = sys.argv
-    # If run_mode is an existing txt file, directly read the runlist instead of run_mode
-    # Make the run_mode name to be the same as the txt file
-    if os.path.exists(run_mode):
-        runlist = load_runlist(run_mode)
-        run_mode = os.path.basename(run_mode).replace(".txt", "")
-    else:
-        runlist = None
+import functools
+from load import LEVELS, make_loader
+from records import write_records, collect, read_manifest, retry_runlists
+from report import report
+from monitor import monitor
+from planner import history, plan, print_plan
+from cache import VerificationCache
+from workqueue import WorkQueue
+
+# Level whose folders the jobs routed to each partition write to
+PARTITION_LEVELS = {"dali": "peaks", "broadwl": "events"}
+
+
+@functools.lru_cache(maxsize=None)
+def _reprocessing_runlists():
+    """Read Jingqiang's reprocessing runlists of SR0 and SR1, once per
+    invocation since the pickles are large."""
+    # Load Jingqiang's runlists for SR0
+    # Reference: https://xe1t-wiki.lngs.infn.it/doku.php?id=xenon:xenonnt_sr1:v12_reprocess
+    with open(
+        "/project2/lgrandi/xenonnt/reprocessing_runlist/global_v12/runlists_reprocessing_global_v12.pickle",
+        "rb",
+    ) as f:
+        jingqiang_sr0 = pickle.load(f)
+        _modes = list(jingqiang_sr0["runlists"].keys())
+        sr0_modes = []
+        for mode in _modes:
+            if "sr0" in mode:
+                sr0_modes.append(mode)
 
-except:
-    print("Usage: python batch.py <str_run_mode> <bool_load_peaks> <bool_load_events>")
-    print("For example: python batch.py sr1_bkg True True")
-    sys.exit(1)
+    # Load Jingqiang's runlists for SR1
+    # Reference: https://xe1t-wiki.lngs.infn.it/doku.php?id=xenon:xenonnt_sr1:v13_reprocess
+    with open(
+        "/project2/lgrandi/xenonnt/reprocessing_runlist/global_v13/runlists_reprocessing_global_v13.pickle",
+        "rb",
+    ) as f:
+        jingqiang_sr1 = pickle.load(f)
+        sr1_modes = list(jingqiang_sr1["runlists"].keys())
+
+    # Combine all runlists
+    all_run_lists = {}
+    for rm in sr0_modes:
+        all_run_lists[rm] = jingqiang_sr0["runlists"][rm]
+    for rm in sr1_modes:
+        all_run_lists[rm] = jingqiang_sr1["runlists"][rm]
+    return sr0_modes, sr1_modes, all_run_lists
 
 
 class Submit:
-    def __init__(self, level=None, run_mode=None, **kwargs):
+    def __init__(
+        self,
+        level=None,
+        run_mode=None,
+        runlist=None,
+        squeue=None,
+        submit_job=None,
+        make_context=None,
+        ram_factor=1.0,
+        **kwargs,
+    ):
         self.run_mode = run_mode
         self.level = level
+        self.runlist = runlist
         self.user = os.environ["USER"]
         self.datetime = time.strftime("%Y%m%d%H%M")
+        # All can be replaced by fakes, to run the submission without slurm or cutax
+        self.squeue = squeue or self._squeue
+        if submit_job is None:
+            import utilix.batchq
+
+            submit_job = utilix.batchq.submit_job
+        self.submit_job = submit_job
+        self.make_context = make_context
+        # Multiplies the memory of the level, when retrying runs which ran out of memory
+        self.ram_factor = ram_factor
+        self._queue_count = None
+        self._queue_time = None
         self._load_config()
 
     def _load_config(self):
@@ -50,6 +105,18 @@ class Submit:
         self.events_cpu = config.getint("utilix", "events_cpu", fallback=1)
         self.t_sleep = config.getint("utilix", "t_sleep", fallback=10)
         self.max_num_submit = config.getint("utilix", "max_num_submit", fallback=2000)
+        self.submit_batch = config.getint("utilix", "submit_batch", fallback=50)
+        self.queue_refresh = config.getint("utilix", "queue_refresh", fallback=60)
+        self.pilots = config.getint("utilix", "pilots", fallback=0)
+        self.size_chunking = config.getboolean("utilix", "size_chunking", fallback=False)
+        self.mb_per_job = config.getfloat("utilix", "mb_per_job", fallback=50000)
+        self.ram_overhead = config.getint("utilix", "ram_overhead", fallback=2000)
+        self.ram_per_mb = config.getfloat("utilix", "ram_per_mb", fallback=2.0)
+        self.prescan = config.getboolean("utilix", "prescan", fallback=True)
+        self.locality_routing = config.getboolean("utilix", "locality_routing", fallback=False)
+        self.partition_map = json.loads(config.get("utilix", "partition_map", fallback="{}"))
+        self.partition_ram = json.loads(config.get("utilix", "partition_ram", fallback="{}"))
+        self.use_cache = config.getboolean("load", "use_cache", fallback=True)
         self.container = config.get("utilix", "container", fallback="xenonnt-development.simg")
         self.peaks_log_dir = config.get("utilix", "peaks_log_dir", fallback=None)
         self.events_log_dir = config.get("utilix", "events_log_dir", fallback=None)
@@ -91,18 +158,26 @@ class Submit:
         )
 
     def _decide_result_filename(self):
-        """Decide the result filename and error filename based on the run mode
+        """Decide the shard folder, where each job writes its own records, and
+        the result and error filenames it is merged into based on the run mode
         and level."""
-        txt_name = f"{self.run_mode}-{self.level}-{self.datetime}-loadable.txt"
-        err_name = f"{self.run_mode}-{self.level}-{self.datetime}-err.txt"
-        if self.level == "peaks":
-            self.result_filename = os.path.join(self.peaks_result_folder, txt_name)
-            self.err_filename = os.path.join(self.peaks_result_folder, err_name)
-            self.logdir = self.peaks_log_dir
-        elif self.level == "events":
-            self.result_filename = os.path.join(self.events_result_folder, txt_name)
-            self.err_filename = os.path.join(self.events_result_folder, err_name)
+        prefix = f"{self.run_mode}-{self.level}-{self.datetime}"
+        if self.level == "events":
+            result_folder = self.events_result_folder
             self.logdir = self.events_log_dir
+        else:
+            # Combined jobs run where the peaks are
+            result_folder = self.peaks_result_folder
+            self.logdir = self.peaks_log_dir
+        self.result_folder = result_folder
+        self.result_folders = {
+            "peaks": self.peaks_result_folder,
+            "events": self.events_result_folder,
+        }
+        self.size_cache_filename = os.path.join(result_folder, "run_sizes.json")
+        self.shard_dir = os.path.join(result_folder, f"{prefix}-shards")
+        self.result_filename = os.path.join(result_folder, f"{prefix}-loadable.txt")
+        self.err_filename = os.path.join(result_folder, f"{prefix}-err.txt")
 
     def _decide_batchq_common_para(self):
         """Decide the common parameters for batchq."""
@@ -117,45 +192,21 @@ class Submit:
             self.qos = "broadwl"
             self.mem_per_cpu = self.events_ram
             self.cpus_per_task = self.events_cpu
+        elif self.level == "both":
+            self.partition = "dali"
+            self.qos = "dali"
+            self.mem_per_cpu = max(self.peaks_ram, self.events_ram)
+            self.cpus_per_task = max(self.peaks_cpu, self.events_cpu)
         else:
-            raise ValueError("Invalid level, please choose from peaks or events")
+            raise ValueError("Invalid level, please choose from peaks, events or both")
+        self.mem_per_cpu = int(self.mem_per_cpu * self.ram_factor)
 
     def _load_runlists(self):
         """Load runlists from Jingqiang's reprocessing runlists."""
-        # Load Jingqiang's runlists for SR0
-        # Reference: https://xe1t-wiki.lngs.infn.it/doku.php?id=xenon:xenonnt_sr1:v12_reprocess
-        with open(
-            "/project2/lgrandi/xenonnt/reprocessing_runlist/global_v12/runlists_reprocessing_global_v12.pickle",
-            "rb",
-        ) as f:
-            jingqiang_sr0 = pickle.load(f)
-            _modes = list(jingqiang_sr0["runlists"].keys())
-            sr0_modes = []
-            for mode in _modes:
-                if "sr0" in mode:
-                    sr0_modes.append(mode)
-            self.sr0_modes = sr0_modes
-
-        # Load Jingqiang's runlists for SR1
-        # Reference: https://xe1t-wiki.lngs.infn.it/doku.php?id=xenon:xenonnt_sr1:v13_reprocess
-        with open(
-            "/project2/lgrandi/xenonnt/reprocessing_runlist/global_v13/runlists_reprocessing_global_v13.pickle",
-            "rb",
-        ) as f:
-            jingqiang_sr1 = pickle.load(f)
-            sr1_modes = list(jingqiang_sr1["runlists"].keys())
-            self.sr1_modes = sr1_modes
-
-        # Combine all runlists
-        all_run_lists = {}
-        for rm in sr0_modes:
-            all_run_lists[rm] = jingqiang_sr0["runlists"][rm]
-        for rm in sr1_modes:
-            all_run_lists[rm] = jingqiang_sr1["runlists"][rm]
-        self.all_run_lists = all_run_lists
+        self.sr0_modes, self.sr1_modes, self.all_run_lists = _reprocessing_runlists()
 
         # Set runlists
-        self.runlist = all_run_lists[self.run_mode]
+        self.runlist = self.all_run_lists[self.run_mode]
 
     def _verify_run_mode(self):
         """Verify the run mode is valid."""
@@ -165,43 +216,313 @@ class Submit:
             is_sr0 or is_sr1
         ), f"Invalid run mode: {self.run_mode}, you can choose from {self.sr0_modes} or {self.sr1_modes}"
 
+    def _scan_storage(self):
+        """Check must_have of the whole runlist in bulk before submission.
+
+        Runs missing any of them are directly recorded in a prescan shard,
+        and only the candidates are left in the runlist.
+        """
+        missing = {}
+        for loader in self._get_loaders():
+            for runid, missing_datatypes in loader.scan_stored().items():
+                missing.setdefault(runid, []).append(
+                    [
+                        loader._record(runid, "storage", data_type, "missing")
+                        for data_type in missing_datatypes
+                    ]
+                )
+        candidates = []
+        records = []
+        for runid, level_records in missing.items():
+            # A combined job still tests the levels which have everything stored
+            if all(level_records):
+                for missing_records in level_records:
+                    records += missing_records
+            else:
+                candidates.append(runid)
+        write_records(os.path.join(self.shard_dir, "prescan.jsonl"), records)
+        print(f"{len(candidates)} out of {len(self.runlist)} runs have all must_have stored.")
+        self.runlist = candidates
+
+    def _skip_verified(self):
+        """Skip runs whose targets were all verified before with the same
+        lineage and container.
+
+        The shards of previous submissions, even interrupted ones, are
+        first ingested into the verification cache. Skipped runs are
+        recorded in a cached shard, so that they still end up loadable.
+        """
+        verified = None
+        for loader in self._get_loaders():
+            cache = VerificationCache(loader.cache_filename)
+            # Combined submissions write the records of all levels to the peaks result folder
+            for result_folder in sorted(set(self.result_folders.values())):
+                cache.ingest(result_folder)
+            level_verified = loader.scan_verified(cache)
+            cache.close()
+            if verified is None:
+                verified = level_verified
+            else:
+                verified = {
+                    runid: verified[runid] + level_verified[runid]
+                    for runid in verified
+                    if runid in level_verified
+                }
+
+        records = []
+        for runid_records in verified.values():
+            records += runid_records
+        write_records(os.path.join(self.shard_dir, "cached.jsonl"), records)
+        print(f"{len(verified)} out of {len(self.runlist)} runs are already verified.")
+        self.runlist = [r for r in self.runlist if str(r).zfill(6) not in verified]
+
+    def _get_loaders(self):
+        """Get the loaders of the levels of this submission on the runlist, to
+        inspect the storage before submission."""
+        if getattr(self, "loader", None) is None:
+            self.loader = make_loader(self.level, self.runlist, make_context=self.make_context)
+        loaders = getattr(self.loader, "loaders", [self.loader])
+        for loader in loaders:
+            loader.runlist = self.runlist
+        return loaders
+
     def _chunk_list(self, **kwargs):
-        """Chunk the list into smaller pieces."""
-        # List comprehension that generates chunks from the list
-        chunk_size = self.runs_per_job
-        lst = self.runlist
-        self.chunked_runlist = [lst[i : i + chunk_size] for i in range(0, len(lst), chunk_size)]
+        """Chunk the list into smaller pieces, separately for the runs of each
+        partition if routing by locality."""
+        if self.locality_routing and self.pilots <= 0:
+            groups = self._route()
+        else:
+            groups = {self.partition: self.runlist}
+        self.chunked_runlist = []
+        self.chunked_mem_per_cpu = []
+        self.chunked_partition = []
+        self.chunked_shard_dir = []
+        self.chunked_logdir = []
+        for partition, runlist in groups.items():
+            mem_per_cpu, shard_dir, logdir = self._partition_folders(partition)
+            if self.size_chunking:
+                chunked_runlist, chunked_mem_per_cpu = self._chunk_list_by_size(
+                    runlist, mem_per_cpu
+                )
+            else:
+                # List comprehension that generates chunks from the list
+                chunk_size = self.runs_per_job
+                lst = runlist
+                chunked_runlist = [lst[i : i + chunk_size] for i in range(0, len(lst), chunk_size)]
+                chunked_mem_per_cpu = [mem_per_cpu] * len(chunked_runlist)
+            self.chunked_runlist += chunked_runlist
+            self.chunked_mem_per_cpu += chunked_mem_per_cpu
+            self.chunked_partition += [partition] * len(chunked_runlist)
+            self.chunked_shard_dir += [shard_dir] * len(chunked_runlist)
+            self.chunked_logdir += [logdir] * len(chunked_runlist)
+
+    def _partition_folders(self, partition):
+        """Memory per cpu, shard folder and log folder of the jobs sent to a
+        partition. The memory is the one of the level tested, wherever the
+        job runs, but jobs routed away from the partition of the level write
+        to the folders of the level running there, since the folders of the
+        level might not be mounted there. Their shard folder is listed in the
+        manifest to be collected."""
+        level = PARTITION_LEVELS.get(partition)
+        if partition == self.partition or level is None:
+            return self.mem_per_cpu, self.shard_dir, self.logdir
+        shard_dir = os.path.join(self.result_folders[level], os.path.basename(self.shard_dir))
+        logdir = getattr(self, f"{level}_log_dir")
+        os.makedirs(shard_dir, exist_ok=True)
+        os.makedirs(logdir, exist_ok=True)
+        frontends_filename = os.path.join(self.shard_dir, "frontends.json")
+        if shard_dir != self.shard_dir and os.path.exists(frontends_filename):
+            shutil.copy(frontends_filename, shard_dir)
+        return self.mem_per_cpu, shard_dir, logdir
+
+    def _fits(self, partition):
+        """Whether a partition provides the memory per cpu of the level, from
+        partition_ram, assuming it does if it is not listed there."""
+        if partition == self.partition or partition not in self.partition_ram:
+            return True
+        return self.mem_per_cpu <= self.partition_ram[partition]
+
+    def _route(self):
+        """Group the runs by the partition closest to the storage holding
+        most of their must_have data types, from the prefixes of
+        partition_map, among the ones providing the memory of the level, and
+        write the latency of each storage frontend for the jobs to order
+        them."""
+        votes = {str(r).zfill(6): {} for r in self.runlist}
+        latency = {}
+        for loader in self._get_loaders():
+            # Measured by the prescan already, unless it is disabled
+            if getattr(loader, "locations", None) is None:
+                loader.scan_stored()
+            for runid in votes:
+                for location in loader.locations.get(runid, {}).values():
+                    partition = self._partition_of(location)
+                    if not self._fits(partition):
+                        continue
+                    votes[runid][partition] = votes[runid].get(partition, 0) + 1
+            for name, values in loader.frontend_latency.items():
+                latency.setdefault(name, []).extend(values)
+
+        latency = {name: float(np.mean(values)) for name, values in latency.items()}
+        with open(os.path.join(self.shard_dir, "frontends.json"), "w") as f:
+            json.dump(latency, f, indent=4)
+        for name, seconds in sorted(latency.items(), key=lambda item: item[1]):
+            print(f"Frontend {name}: {seconds * 1e3:.2f} ms per key")
+
+        groups = {}
+        for runid, partition_votes in votes.items():
+            partition = self.partition
+            if partition_votes:
+                partition = max(partition_votes, key=partition_votes.get)
+            groups.setdefault(partition, []).append(runid)
+        for partition, runlist in groups.items():
+            print(f"{len(runlist)} runs routed to partition {partition}")
+        return groups
+
+    def _partition_of(self, location):
+        """Partition of the longest prefix of partition_map matching a storage
+        location, or the one of the level if none does."""
+        matches = [prefix for prefix in self.partition_map if location.startswith(prefix)]
+        if not matches:
+            return self.partition
+        return self.partition_map[max(matches, key=len)]
+
+    def _chunk_list_by_size(self, runlist, mem_per_cpu):
+        """Pack runs into jobs of roughly mb_per_job data each, largest run
+        first into the lightest job, and size the memory of each job to its
+        largest run, capped by mem_per_cpu."""
+        sizes = {str(r).zfill(6): 0.0 for r in runlist}
+        for loader in self._get_loaders():
+            level_sizes = loader.scan_sizes(self.size_cache_filename)
+            for runid in sizes:
+                sizes[runid] += level_sizes[runid]
+        n_jobs = max(1, int(np.ceil(sum(sizes.values()) / self.mb_per_job)))
+        n_jobs = min(n_jobs, len(sizes))
+
+        jobs = [(0.0, i) for i in range(n_jobs)]
+        chunked_runlist = [[] for _ in range(n_jobs)]
+        for runid in sorted(sizes, key=sizes.get, reverse=True):
+            load, i = heapq.heappop(jobs)
+            chunked_runlist[i].append(runid)
+            heapq.heappush(jobs, (load + sizes[runid], i))
+
+        chunked_mem_per_cpu = [
+            min(
+                mem_per_cpu,
+                int(
+                    self.ram_factor
+                    * (self.ram_overhead + self.ram_per_mb * max(sizes[r] for r in chunk))
+                ),
+            )
+            for chunk in chunked_runlist
+        ]
+        for load, i in sorted(jobs):
+            print(
+                f"Job {i}: {len(chunked_runlist[i])} runs, {load:.0f} MB, "
+                f"{chunked_mem_per_cpu[i]} MB memory per cpu"
+            )
+        return chunked_runlist, chunked_mem_per_cpu
+
+    def _squeue(self):
+        """Count the jobs of the user in the slurm queue."""
+        cmd = ["squeue", f"--user={self.user}", "--noheader", "--format=%i"]
+        output = subprocess.run(cmd, capture_output=True, text=True, check=True).stdout
+        return len(output.split())
 
     def _working_job(self):
-        """Get the number of working jobs."""
-        cmd = "squeue --user={user} | wc -l".format(user=self.user)
-        job_num = int(os.popen(cmd).read())
-        return job_num - 1
+        """Get the number of working jobs, from a queue view refreshed at most
+        every queue_refresh seconds and counting our submissions since."""
+        now = time.time()
+        if self._queue_time is None or now - self._queue_time >= self.queue_refresh:
+            self._queue_count = self.squeue()
+            self._queue_time = now
+        return self._queue_count
+
+    def _jobname(self, loop_index):
+        """Name of the job of a chunk."""
+        return "loadtest_%s_%s_%s" % (self.level, self.run_mode, loop_index)
+
+    def _write_manifest(self):
+        """Write the chunks of runs of all jobs to the shard folder, so that
+        the runs of killed jobs can be found afterwards."""
+        manifest = {
+            "level": self.level,
+            "run_mode": self.run_mode,
+            "levels": LEVELS if self.level == "both" else [self.level],
+            "jobs": {},
+        }
+        for i, chunk in enumerate(self.chunked_runlist):
+            jobname = self._jobname(i)
+            manifest["jobs"][jobname] = {
+                "runs": [str(r).zfill(6) for r in chunk],
+                "mem_per_cpu": self.chunked_mem_per_cpu[i],
+                "partition": self.chunked_partition[i],
+                "shard": os.path.join(self.chunked_shard_dir[i], jobname + ".jsonl"),
+                # Pilots pull chunks from the queue, so their logs cannot be attributed to a chunk
+                "log": (
+                    None
+                    if self.pilots > 0
+                    else os.path.join(self.chunked_logdir[i], jobname + ".log")
+                ),
+            }
+        with open(os.path.join(self.shard_dir, "manifest.json"), "w") as f:
+            json.dump(manifest, f)
 
     def _submit_single(self, loop_index, loop_item):
         """Submit a single job using utilix.batchq."""
-        batch_i = loop_index
-        jobname = "loadtest_%s_%s_%s" % (self.level, self.run_mode, batch_i)
-        jobstring = "python {script} {level} '{loop_item}' {result_filename} {err_filename}".format(
+        jobname = self._jobname(loop_index)
+        # Zero-padded run ids are not valid python literals, so the chunk is passed as json
+        jobstring = "python {script} {level} {loop_item} {shard_filename}".format(
             script=self.script,
             level=self.level,
-            loop_item=list(loop_item),
-            result_filename=self.result_filename,
-            err_filename=self.err_filename,
+            loop_item=shlex.quote(json.dumps([str(r).zfill(6) for r in loop_item])),
+            shard_filename=os.path.join(self.chunked_shard_dir[loop_index], jobname + ".jsonl"),
         )
-        log = os.path.join(self.logdir, jobname + ".log")
+        self._submit_job(
+            jobname,
+            jobstring,
+            self.chunked_mem_per_cpu[loop_index],
+            self.chunked_partition[loop_index],
+            self.chunked_logdir[loop_index],
+        )
+
+    def _submit_pilot(self, loop_index, loop_item):
+        """Submit a single pilot, pulling chunks from the work queue until it
+        is empty."""
+        jobname = "loadtest_pilot_%s_%s_%s" % (self.level, self.run_mode, loop_index)
+        jobstring = "python {script} pilot {level} {queue_dir} {shard_filename}".format(
+            script=self.script,
+            level=self.level,
+            queue_dir=self.queue_dir,
+            shard_filename=os.path.join(self.shard_dir, jobname + ".jsonl"),
+        )
+        self._submit_job(jobname, jobstring, max(self.chunked_mem_per_cpu))
+
+    def _fill_queue(self):
+        """Put all chunks into the work queue of the pilots."""
+        self.queue_dir = os.path.join(self.shard_dir, "queue")
+        WorkQueue(self.queue_dir).put(self.chunked_runlist)
+        print(f"Put {len(self.chunked_runlist)} chunks into {self.queue_dir}")
+
+    def _submit_job(self, jobname, jobstring, mem_per_cpu, partition=None, logdir=None):
+        """Submit a job using utilix.batchq, on the partition and with the log
+        folder of the level unless others are given."""
+        log = os.path.join(logdir or self.logdir, jobname + ".log")
+        partition = partition or self.partition
+        # The qos of each partition is named after it
+        qos = self.qos if partition == self.partition else partition
 
         print("Submitting job: ", jobname)
         print("Command: ", jobstring)
         if not self.debug:
-            utilix.batchq.submit_job(
+            self.submit_job(
                 jobstring=jobstring,
                 log=log,
-                partition=self.partition,
-                qos=self.qos,
+                partition=partition,
+                qos=qos,
                 account=self.account,
                 jobname=jobname,
-                mem_per_cpu=self.mem_per_cpu,
+                mem_per_cpu=mem_per_cpu,
                 container=self.container,
                 cpus_per_task=self.cpus_per_task,
             )
@@ -210,11 +531,11 @@ class Submit:
         print("Context configuration:")
         print(
             "Output folder (if allowed computing): ",
-            self.peaks_output_folder if self.level == "peaks" else self.events_output_folder,
+            self.events_output_folder if self.level == "events" else self.peaks_output_folder,
         )
         print(
             "Storage to patch (if allowed computing): ",
-            self.peaks_storage_to_patch if self.level == "peaks" else self.events_storage_to_patch,
+            self.events_storage_to_patch if self.level == "events" else self.peaks_storage_to_patch,
         )
         print("Allow generating new data:")
         print("    Peaks: ", self.allow_peaks_computation)
@@ -222,35 +543,45 @@ class Submit:
 
     def _make_folders(self):
         """Make folders for the results."""
-        if self.level == "peaks":
+        if self.level in ["peaks", "both"]:
             if not os.path.exists(self.peaks_result_folder):
                 os.makedirs(self.peaks_result_folder)
             if not os.path.exists(self.peaks_log_dir):
                 os.makedirs(self.peaks_log_dir)
-        elif self.level == "events":
+        if self.level in ["events", "both"]:
             if not os.path.exists(self.events_result_folder):
                 os.makedirs(self.events_result_folder)
             if not os.path.exists(self.events_log_dir):
                 os.makedirs(self.events_log_dir)
+        os.makedirs(self.shard_dir, exist_ok=True)
 
     def prepare(self):
         """Prepare the submission."""
-        if runlist is not None:
-            self.runlist = runlist
-        else:
+        if self.runlist is None:
             self._load_runlists()
             self._verify_run_mode()
         self._decide_batchq_common_para()
         self._decide_result_filename()
         self.script = os.path.join(os.path.dirname(__file__), "load.py")
-        self._chunk_list()
         self._make_folders()
+        if self.prescan:
+            self._scan_storage()
+        if self.use_cache:
+            self._skip_verified()
+        self._chunk_list()
+        self._write_manifest()
 
     def submit(self):
         """Submit the jobs."""
         self.prepare()
 
-        loop_over = self.chunked_runlist
+        if self.pilots > 0 and self.chunked_runlist:
+            self._fill_queue()
+            submit_single = self._submit_pilot
+            loop_over = list(range(min(self.pilots, len(self.chunked_runlist))))
+        else:
+            submit_single = self._submit_single
+            loop_over = self.chunked_runlist
         max_num_submit = self.max_num_submit
 
         self.max_num_submit = max_num_submit
@@ -258,21 +589,185 @@ class Submit:
 
         index = 0
         while index < len(self.loop_over):
-            if self._working_job() < self.max_num_submit:
-                self._submit_single(loop_index=index, loop_item=self.loop_over[index])
+            headroom = self.max_num_submit - self._working_job()
+            if headroom <= 0:
+                # Block until the next refresh of the queue view instead of spinning
+                time.sleep(max(self._queue_time + self.queue_refresh - time.time(), self.t_sleep))
+                continue
 
-                time.sleep(self.t_sleep)
+            # Submit as many jobs as fit in the queue in one batch
+            for _ in range(min(headroom, self.submit_batch, len(self.loop_over) - index)):
+                submit_single(loop_index=index, loop_item=self.loop_over[index])
+                self._queue_count += 1
                 index += 1
+            time.sleep(self.t_sleep)
+
+        print("Follow the progress of the jobs by:")
+        print(f"python batch.py monitor {self.shard_dir} 60")
+        print("Once all jobs are finished, merge their results by:")
+        print(f"python batch.py collect {self.shard_dir}")
+
+
+def retry(shard_dir):
+    """Resubmit the runs of a submission which failed only because of
+    retryable errors, with retry_ram_factor times more memory for the ones
+    which ran out of memory."""
+    manifest = read_manifest(shard_dir)
+    if manifest is not None:
+        level, run_mode = manifest["level"], manifest["run_mode"]
+    else:
+        # <run_mode>-<level>-<datetime>-shards
+        run_mode, level, _, _ = os.path.basename(shard_dir.rstrip("/")).rsplit("-", 3)
+    config = configparser.ConfigParser()
+    config.read("config.ini")
+    retry_ram_factor = config.getfloat("utilix", "retry_ram_factor", fallback=2.0)
+
+    oom, others = retry_runlists(shard_dir)
+    print(f"{len(oom)} runs ran out of memory, {len(others)} runs failed otherwise retryably.")
+    for runlist, suffix, ram_factor in [
+        (others, "retry", 1.0),
+        (oom, "retry_oom", retry_ram_factor),
+    ]:
+        if runlist:
+            print(f"Resubmitting {len(runlist)} runs with {ram_factor} times the memory...")
+            Submit(
+                level=level,
+                run_mode=f"{run_mode}_{suffix}",
+                runlist=runlist,
+                ram_factor=ram_factor,
+            ).submit()
+
+
+def plan_campaign(run_mode, level, runlist=None, make_context=None):
+    """Dry run of a submission, predicting the memory and wall time of its
+    jobs and its completion time from the runs tested before, and
+    recommending settings, without submitting anything."""
+    submit = Submit(
+        level=level,
+        run_mode=run_mode,
+        runlist=runlist,
+        submit_job=lambda **kwargs: None,
+        make_context=make_context,
+    )
+    if submit.runlist is None:
+        submit._load_runlists()
+        submit._verify_run_mode()
+    submit._decide_batchq_common_para()
+    submit._decide_result_filename()
+    os.makedirs(submit.result_folder, exist_ok=True)
+    runids = [str(r).zfill(6) for r in submit.runlist]
+
+    levels = LEVELS if level == "both" else [level]
+    samples = history([submit.result_folders[lv] for lv in levels], levels)
+    print(f"{len(samples)} runs tested before in the result folders.")
+
+    # Sizes of the runs tested before too, to fit the model
+    submit.runlist = sorted(set(runids) | {sample["run"] for sample in samples})
+    sizes = {}
+    for loader in submit._get_loaders():
+        for runid, size in loader.scan_sizes(submit.size_cache_filename).items():
+            sizes[runid] = sizes.get(runid, 0.0) + size
+
+    config = submit.config
+    settings = {
+        "runs_per_job": submit.runs_per_job,
+        "mem_per_cpu": submit.mem_per_cpu,
+        "cpus_per_task": submit.cpus_per_task,
+        "max_num_submit": submit.max_num_submit,
+        "ram_overhead": submit.ram_overhead,
+        "ram_per_mb": submit.ram_per_mb,
+        "min_history": config.getint("planner", "min_history", fallback=20),
+        "time_overhead": config.getfloat("planner", "time_overhead", fallback=60),
+        "time_per_mb": config.getfloat("planner", "time_per_mb", fallback=0.05),
+        "job_startup": config.getfloat("planner", "job_startup", fallback=120),
+        "max_job_hours": config.getfloat("planner", "max_job_hours", fallback=24),
+    }
+    result = plan(runids, sizes, samples, settings)
+    result["settings"] = settings
+    print_plan(result, [f"{lv}_ram" for lv in levels])
+
+    plan_filename = os.path.join(
+        submit.result_folder, f"{submit.run_mode}-{level}-{submit.datetime}-plan.json"
+    )
+    with open(plan_filename, "w") as f:
+        json.dump(result, f, indent=4)
+    print(f"Plan filename: {plan_filename}")
+    return result
 
 
 if __name__ == "__main__":
+    if len(sys.argv) == 3 and sys.argv[1] == "collect":
+        collect(sys.argv[2])
+        sys.exit(0)
+    if len(sys.argv) in [3, 4] and sys.argv[1] == "monitor":
+        config = configparser.ConfigParser()
+        config.read("config.ini")
+        monitor(
+            sys.argv[2],
+            refresh=int(sys.argv[3]) if len(sys.argv) == 4 else 0,
+            # A job missing three heartbeats in a row is considered dead
+            dead_after=3 * config.getint("load", "heartbeat_interval", fallback=60),
+            stall_after=config.getint("utilix", "stall_after", fallback=1800),
+        )
+        sys.exit(0)
+    if len(sys.argv) == 4 and sys.argv[1] == "plan":
+        from utilix.io import load_runlist
+
+        _, _, run_mode, level = sys.argv
+        runlist = None
+        if os.path.exists(run_mode):
+            runlist = load_runlist(run_mode)
+            run_mode = os.path.basename(run_mode).replace(".txt", "")
+        plan_campaign(run_mode, level, runlist)
+        sys.exit(0)
+    if len(sys.argv) == 3 and sys.argv[1] == "retry":
+        retry(sys.argv[2])
+        sys.exit(0)
+    if len(sys.argv) >= 3 and sys.argv[1] == "report":
+        report(sys.argv[2:])
+        sys.exit(0)
+
+    from utilix.io import load_runlist
+
+    try:
+        _, run_mode, load_peaks, load_events = sys.argv
+        # If run_mode is an existing txt file, directly read the runlist instead of run_mode
+        # Make the run_mode name to be the same as the txt file
+        if os.path.exists(run_mode):
+            runlist = load_runlist(run_mode)
+            run_mode = os.path.basename(run_mode).replace(".txt", "")
+        else:
+            runlist = None
+
+    except:
+        print("Usage: python batch.py <str_run_mode> <bool_load_peaks> <bool_load_events>")
+        print("       python batch.py collect <shard_dir>")
+        print("       python batch.py report <shard_dir> [<shard_dir> ...]")
+        print("       python batch.py retry <shard_dir>")
+        print("       python batch.py monitor <shard_dir> [<refresh_seconds>]")
+        print("       python batch.py plan <str_run_mode> <level>")
+        print("For example: python batch.py sr1_bkg True True")
+        sys.exit(1)
+
+    config = configparser.ConfigParser()
+    config.read("config.ini")
+    if (
+        eval(load_peaks)
+        and eval(load_events)
+        and config.getboolean("utilix", "combine_levels", fallback=False)
+    ):
+        print("Submitting combined peaks and events loading jobs...")
+        both_submit = Submit(level="both", run_mode=run_mode, runlist=runlist)
+        both_submit.submit()
+        print("Finished submitting combined loading jobs...")
+        sys.exit(0)
     if eval(load_peaks):
         print("Submitting peaks loading jobs...")
-        peaks_submit = Submit(level="peaks", run_mode=run_mode)
+        peaks_submit = Submit(level="peaks", run_mode=run_mode, runlist=runlist)
         peaks_submit.submit()
         print("Finished submitting peaks loading jobs...")
     if eval(load_events):
         print("Submitting events loading jobs...")
-        events_submit = Submit(level="events", run_mode=run_mode)
+        events_submit = Submit(level="events", run_mode=run_mode, runlist=runlist)
         events_submit.submit()
         print("Finished submitting events loading jobs...")
@@ -0,0 +1,502 @@
+import os
+import bz2
+import json
+import time
+import shlex
+import shutil
+import hashlib
+import argparse
+import tempfile
+import contextlib
+import configparser
+import numpy as np
+from load import make_loader
+from batch import Submit
+from records import read_shard, summarize_runs
+
+# Synthetic data types and their data kinds, data types of the same kind share their time
+DATA_KINDS = {
+    "peaklets": "peaklets",
+    "peak_basics": "peaklets",
+    "lone_hits": "lone_hits",
+    "event_basics": "events",
+    "event_info": "events",
+}
+MUST_HAVE = {
+    "peaks": ["peaklets", "lone_hits", "peak_basics"],
+    "events": ["event_basics", "event_info"],
+}
+TARGETS = {
+    "peaks": [["peaklets", "peak_basics"], ["peak_basics"], ["lone_hits"]],
+    "events": [["event_info"], ["event_basics", "event_info"]],
+}
+# Data types each synthetic data type is computed from, for the lineage
+DEPENDS_ON = {
+    "peaklets": [],
+    "lone_hits": [],
+    "peak_basics": ["peaklets"],
+    "event_basics": ["peak_basics"],
+    "event_info": ["event_basics"],
+}
+# Heavy waveform-like field of each data type, in number of float32 samples
+N_SAMPLES = {"peaklets": 200, "lone_hits": 0, "peak_basics": 0, "event_basics": 8, "event_info": 32}
+CHUNK_LENGTH = int(1e9)
+# Options in [load] of each loading mode, on top of the ones of get_array
+MODES = {
+    "get_array": {
+        "streaming": "False",
+        "tiered": "False",
+        "tier2_fraction": "1.0",
+        "shared_plan": "False",
+        "sampled": "False",
+        "prefetch_runs": "0",
+        "diagnose": "False",
+    },
+    "streaming": {"streaming": "True"},
+    "tiered": {"tiered": "True", "tier2_fraction": "0.0"},
+    "shared_plan": {"shared_plan": "True"},
+    "sampled": {"sampled": "True", "sample_chunks": "1"},
+    "prefetch": {"prefetch_runs": "1"},
+    "diagnose": {"diagnose": "True"},
+}
+
+COMPRESSORS = {"bz2": (bz2.compress, bz2.decompress)}
+try:
+    import zstd
+
+    COMPRESSORS["zstd"] = (zstd.compress, zstd.decompress)
+except ImportError:
+    pass
+try:
+    import blosc
+
+    COMPRESSORS["blosc"] = (blosc.compress, blosc.decompress)
+except ImportError:
+    pass
+
+
+def _lineage_hash(data_type):
+    """Deterministic stand-in of the strax lineage hash."""
+    return hashlib.sha1(f"{data_type}-v0".encode()).hexdigest()[:10]
+
+
+def _lineage(data_type):
+    """Stand-in of the strax lineage, the data type and all the ones it
+    depends on."""
+    lineage = {data_type: (f"Fake{data_type}", "0.0.0", {})}
+    for dependency in DEPENDS_ON[data_type]:
+        lineage.update(_lineage(dependency))
+    return lineage
+
+
+def _dtype(data_type):
+    """Structured dtype of a synthetic data type, like strax intervals."""
+    dtype = [
+        ("time", np.int64),
+        ("length", np.int32),
+        ("dt", np.int16),
+        ("channel", np.int16),
+        ("area", np.float32),
+    ]
+    if N_SAMPLES[data_type]:
+        dtype.append(("data", np.float32, (N_SAMPLES[data_type],)))
+    return np.dtype(dtype)
+
+
+class FakeKey:
+    """Stand-in of strax.DataKey."""
+
+    def __init__(self, run_id, data_type):
+        self.run_id = run_id
+        self.data_type = data_type
+        self.lineage_hash = _lineage_hash(data_type)
+        self.lineage = _lineage(data_type)
+
+    def __str__(self):
+        return f"{self.run_id}-{self.data_type}-{self.lineage_hash}"
+
+
+class FakeChunk:
+    """Stand-in of strax.Chunk."""
+
+    def __init__(self, start, end, data):
+        self.start = start
+        self.end = end
+        self.data = data
+
+    def __len__(self):
+        return len(self.data)
+
+
+class FakeFrontend:
+    """Stand-in of a strax storage frontend on a local folder in the strax
+    layout."""
+
+    def __init__(self, root):
+        self.root = root
+
+    def metadata_path(self, key):
+        return os.path.join(
+            self.root, str(key), f"{key.data_type}-{key.lineage_hash}-metadata.json"
+        )
+
+    def find_several(self, keys, **kwargs):
+        return [
+            (
+                ("FakeBackend", os.path.join(self.root, str(key)))
+                if os.path.exists(self.metadata_path(key))
+                else False
+            )
+            for key in keys
+        ]
+
+    def __repr__(self):
+        return f"FakeFrontend({self.root})"
+
+
+class FakePlugin:
+    """Stand-in of strax.Plugin."""
+
+    def data_kind_for(self, data_type):
+        return DATA_KINDS[data_type]
+
+
+class FakeContext:
+    """Stand-in of a strax context with the subset of its interface used by
+    Loader, reading the synthetic data of make_data."""
+
+    _find_options = {}
+
+    def __init__(self, root):
+        self.storage = [FakeFrontend(root)]
+
+    def key_for(self, run_id, target):
+        return FakeKey(run_id, target)
+
+    def keys_for_runs(self, target, run_ids):
+        return [self.key_for(run_id, target) for run_id in run_ids]
+
+    def is_stored(self, run_id, target):
+        return bool(self.storage[0].find_several([self.key_for(run_id, target)])[0])
+
+    def get_single_plugin(self, run_id, target):
+        return FakePlugin()
+
+    def run_metadata(self, run_id, projection=None):
+        return {"mode": "synthetic"}
+
+    def get_metadata(self, run_id, target):
+        with open(self.storage[0].metadata_path(self.key_for(run_id, target)), "r") as f:
+            return json.load(f)
+
+    def _load_chunk(self, run_id, target, metadata, chunk_i):
+        """Read and decompress a single chunk."""
+        key = self.key_for(run_id, target)
+        filename = os.path.join(
+            self.storage[0].root, str(key), metadata["chunks"][chunk_i]["filename"]
+        )
+        with open(filename, "rb") as f:
+            data = COMPRESSORS[metadata["compressor"]][1](f.read())
+        return np.frombuffer(data, dtype=_dtype(target))
+
+    def get_iter(
+        self, run_id, targets, keep_columns=None, progress_bar=True, time_range=None, **kwargs
+    ):
+        targets = [targets] if isinstance(targets, str) else list(targets)
+        if isinstance(keep_columns, str):
+            keep_columns = (keep_columns,)
+        metadata = {target: self.get_metadata(run_id, target) for target in targets}
+        if len({DATA_KINDS[target] for target in targets}) > 1:
+            raise ValueError(f"Cannot load {targets} of different data kinds together")
+
+        for chunk_i, chunk_info in enumerate(metadata[targets[0]]["chunks"]):
+            if time_range is not None and not (
+                chunk_info["end"] > time_range[0] and chunk_info["start"] < time_range[1]
+            ):
+                continue
+            arrays = [self._load_chunk(run_id, t, metadata[t], chunk_i) for t in targets]
+            for array in arrays[1:]:
+                if len(array) != len(arrays[0]) or np.any(array["time"] != arrays[0]["time"]):
+                    raise ValueError(f"Cannot merge chunk {chunk_i} of {targets}")
+            yield FakeChunk(chunk_info["start"], chunk_info["end"], _merge(arrays, keep_columns))
+
+    def get_array(self, run_id, targets, keep_columns=None, time_range=None, **kwargs):
+        chunks = [
+            chunk.data for chunk in self.get_iter(run_id, targets, keep_columns, False, time_range)
+        ]
+        data = np.concatenate(chunks)
+        if time_range is not None:
+            data = data[(data["time"] >= time_range[0]) & (data["time"] < time_range[1])]
+        return data
+
+
+def _merge(arrays, keep_columns=None):
+    """Merge arrays of the same data kind field by field, keeping only some
+    columns if asked."""
+    fields = {}
+    for array in arrays:
+        for name in array.dtype.names:
+            if keep_columns is None or name in keep_columns:
+                fields.setdefault(name, array[name])
+    merged = np.zeros(len(arrays[0]), dtype=[(n, v.dtype, v.shape[1:]) for n, v in fields.items()])
+    for name, values in fields.items():
+        merged[name] = values
+    return merged
+
+
+def make_data(root, runids, n_chunks, chunk_mb, failure_rate, compressor, seed):
+    """Write synthetic strax-format data of all runs, where a fraction of the
+    runs has a missing or truncated data type.
+
+    Return the injected failures.
+    """
+    compress = COMPRESSORS[compressor][0]
+    rng = np.random.default_rng(seed)
+    failures = {}
+    for runid in runids:
+        data_types = sorted({d for level in MUST_HAVE.values() for d in level})
+        broken = None
+        if rng.random() < failure_rate:
+            broken = (str(rng.choice(data_types)), str(rng.choice(["missing", "truncated"])))
+            failures[runid] = broken
+
+        # Times of each data kind, shared by its data types
+        times = {}
+        for kind in sorted(set(DATA_KINDS.values())):
+            largest = max(_dtype(d).itemsize for d in DATA_KINDS if DATA_KINDS[d] == kind)
+            n = int(chunk_mb * 1e6 / largest)
+            times[kind] = [
+                np.sort(rng.integers(i * CHUNK_LENGTH, (i + 1) * CHUNK_LENGTH - 1000, n))
+                for i in range(n_chunks)
+            ]
+
+        for data_type in data_types:
+            if broken is not None and broken == (data_type, "missing"):
+                continue
+            key = FakeKey(runid, data_type)
+            folder = os.path.join(root, str(key))
+            os.makedirs(folder, exist_ok=True)
+            chunks = []
+            for chunk_i, chunk_times in enumerate(times[DATA_KINDS[data_type]]):
+                data = np.zeros(len(chunk_times), dtype=_dtype(data_type))
+                data["time"] = chunk_times
+                data["length"] = 10
+                data["dt"] = 10
+                data["area"] = rng.random(len(data))
+                if "data" in data.dtype.names:
+                    # Mostly baseline with some signal, to compress like waveforms
+                    data["data"] = rng.poisson(0.5, data["data"].shape)
+                filename = f"{data_type}-{key.lineage_hash}-{chunk_i:06d}"
+                compressed = compress(data.tobytes())
+                filesize = len(compressed)
+                if broken == (data_type, "truncated") and chunk_i == n_chunks // 2:
+                    compressed = compressed[: len(compressed) // 2]
+                with open(os.path.join(folder, filename), "wb") as f:
+                    f.write(compressed)
+                chunks.append(
+                    {
+                        "chunk_i": chunk_i,
+                        "filename": filename,
+                        "filesize": filesize,
+                        "n": len(data),
+                        "nbytes": data.nbytes,
+                        "start": chunk_i * CHUNK_LENGTH,
+                        "end": (chunk_i + 1) * CHUNK_LENGTH,
+                        "first_time": int(data["time"][0]) if len(data) else None,
+                        "last_time": int(data["time"][-1]) if len(data) else None,
+                        "run_id": runid,
+                    }
+                )
+            metadata = {
+                "run_id": runid,
+                "data_type": data_type,
+                "data_kind": DATA_KINDS[data_type],
+                "lineage_hash": key.lineage_hash,
+                "compressor": compressor,
+                "dtype": repr(data.dtype.descr),
+                "chunks": chunks,
+            }
+            with open(FakeFrontend(root).metadata_path(key), "w") as f:
+                json.dump(metadata, f)
+    return failures
+
+
+class FakeSlurm:
+    """Stand-in of squeue and sbatch, where each job stays in the queue for a
+    fixed time."""
+
+    def __init__(self, job_time):
+        self.job_time = job_time
+        self.end_times = []
+        self.n_squeue = 0
+
+    def squeue(self):
+        self.n_squeue += 1
+        now = time.time()
+        return sum(end_time > now for end_time in self.end_times)
+
+    def submit_job(self, jobstring, **kwargs):
+        # Parse the command line the way the shell of the job and load.py do
+        args = shlex.split(jobstring)
+        if args[2] != "pilot":
+            json.loads(args[3])
+        self.end_times.append(time.time() + self.job_time)
+
+
+def write_config(workdir, args):
+    """Write the config.ini of the benchmark, based on the one of the repo."""
+    config = configparser.ConfigParser()
+    config.read(os.path.join(os.path.dirname(os.path.abspath(__file__)), "config.ini"))
+    for section in ["general", "utilix", "context", "load"]:
+        if not config.has_section(section):
+            config.add_section(section)
+    config.set("general", "debug", "False")
+    config.set("utilix", "t_sleep", "0")
+    config.set("utilix", "queue_refresh", str(args.queue_refresh))
+    config.set("utilix", "max_num_submit", str(args.max_num_submit))
+    config.set("utilix", "runs_per_job", str(args.runs_per_job))
+    config.set("utilix", "pilots", "0")
+    # All synthetic data is on the local disk of the benchmark
+    config.set("utilix", "partition_map", json.dumps({workdir: "local"}))
+    for level in ["peaks", "events"]:
+        config.set("utilix", f"{level}_log_dir", os.path.join(workdir, "logs"))
+        config.set("context", f"{level}_result_folder", os.path.join(workdir, "results"))
+        config.set("context", f"{level}_output_folder", os.path.join(workdir, "output"))
+    config.set("load", "must_have", json.dumps(MUST_HAVE))
+    config.set("load", "targets", json.dumps(TARGETS))
+    config.set("load", "never_save", "[]")
+    config.set("load", "use_cache", "False")
+    with open(os.path.join(workdir, "config.ini"), "w") as f:
+        config.write(f)
+    return config
+
+
+def bench_loader(workdir, make_context, runids, level, mode, n_workers):
+    """Load test all runs with a Loader in one of the modes and measure its
+    throughput."""
+    config = configparser.ConfigParser()
+    config.read("config.ini")
+    for option, value in {**MODES["get_array"], **MODES[mode]}.items():
+        config.set("load", option, value)
+    config.set("load", "n_workers", str(n_workers))
+    with open("config.ini", "w") as f:
+        config.write(f)
+
+    shard_filename = os.path.join(workdir, f"bench-{level}-{mode}-{n_workers}.jsonl")
+    loader = make_loader(level, runids, shard_filename, make_context)
+    t0 = time.time()
+    loader.loadtest()
+    loader.close()
+    elapsed = time.time() - t0
+
+    records = read_shard(shard_filename)
+    summary = summarize_runs(records)
+    mb = sum(r["bytes_read"] or 0 for r in records if "bytes_read" in r) / 1e6
+    os.remove(shard_filename)
+    return {
+        "runs_per_s": len(runids) / elapsed,
+        "mb_per_s": mb / elapsed,
+        "peak_rss": max((r["peak_rss"] or 0) for r in records if "peak_rss" in r),
+        "loadable": sum(run["loadable"] for run in summary.values()),
+        "time": elapsed,
+    }
+
+
+def bench_submit(make_context, runids, level, job_time):
+    """Run the submission of all runs against fake squeue and sbatch."""
+    slurm = FakeSlurm(job_time)
+    submit = Submit(
+        level=level,
+        run_mode="benchmark",
+        runlist=runids,
+        squeue=slurm.squeue,
+        submit_job=slurm.submit_job,
+        make_context=make_context,
+    )
+    t0 = time.time()
+    submit.submit()
+    return {
+        "time": time.time() - t0,
+        "jobs": len(slurm.end_times),
+        "squeue_calls": slurm.n_squeue,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark Loader and Submit against synthetic strax data."
+    )
+    parser.add_argument("--runs", type=int, default=20, help="Number of runs")
+    parser.add_argument("--chunks", type=int, default=10, help="Number of chunks per run")
+    parser.add_argument("--chunk-mb", type=float, default=2, help="Size of a chunk in MB")
+    parser.add_argument("--failure-rate", type=float, default=0.1, help="Fraction of broken runs")
+    parser.add_argument("--compressor", default=list(COMPRESSORS)[-1], choices=sorted(COMPRESSORS))
+    parser.add_argument("--workers", default="1,4", help="Comma separated numbers of workers")
+    parser.add_argument(
+        "--modes", default=",".join(MODES), help=f"Comma separated modes among {list(MODES)}"
+    )
+    parser.add_argument("--level", default="peaks", choices=["peaks", "events", "both"])
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--runs-per-job", type=int, default=2)
+    parser.add_argument("--max-num-submit", type=int, default=5)
+    parser.add_argument("--queue-refresh", type=int, default=1)
+    parser.add_argument("--job-time", type=float, default=0.2, help="Time of a fake job in s")
+    parser.add_argument("--dir", default=None, help="Folder for the data, temporary by default")
+    args = parser.parse_args()
+
+    workdir = os.path.abspath(args.dir or tempfile.mkdtemp(prefix="loadtest-benchmark-"))
+    os.makedirs(workdir, exist_ok=True)
+    os.environ.setdefault("USER", "benchmark")
+    runids = [str(r).zfill(6) for r in range(args.runs)]
+    data_root = os.path.join(workdir, "strax_data")
+
+    print(f"Writing {args.runs} runs of {args.chunks} chunks of {args.chunk_mb} MB to {workdir}")
+    failures = make_data(
+        data_root,
+        runids,
+        args.chunks,
+        args.chunk_mb,
+        args.failure_rate,
+        args.compressor,
+        args.seed,
+    )
+    print(f"Injected failures: {failures}")
+
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    write_config(workdir, args)
+    make_context = lambda level: FakeContext(data_root)
+    results = {}
+    try:
+        # The loader and submitter are verbose, keep their output aside
+        with open(os.path.join(workdir, "benchmark.log"), "w") as log, contextlib.redirect_stdout(
+            log
+        ):
+            for mode in args.modes.split(","):
+                for n_workers in [int(n) for n in args.workers.split(",")]:
+                    results[f"{mode} mode, {n_workers} workers"] = bench_loader(
+                        workdir, make_context, runids, args.level, mode, n_workers
+                    )
+            results["submit"] = bench_submit(make_context, runids, args.level, args.job_time)
+    finally:
+        os.chdir(cwd)
+
+    print("--------------------")
+    for name, result in results.items():
+        if name == "submit":
+            print(
+                f"Submission: {result['jobs']} jobs in {result['time']:.2f} s with "
+                f"{result['squeue_calls']} squeue calls"
+            )
+        else:
+            print(
+                f"Loading with {name}: {result['runs_per_s']:.2f} runs/s, "
+                f"{result['mb_per_s']:.1f} MB/s, {result['peak_rss']:.0f} MB peak RSS, "
+                f"{result['loadable']}/{len(runids)} loadable"
+            )
+    if args.dir is None:
+        shutil.rmtree(workdir)
+
+
+if __name__ == "__main__":
+    main()
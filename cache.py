@@ -0,0 +1,79 @@
+import os
+import json
+import glob
+import sqlite3
+from records import read_shard
+
+
+class VerificationCache:
+    """Persistent cache of the verified combinations of run, targets, strax
+    lineage and container, in a SQLite file under the result folder.
+
+    Only batch.py writes to it, by ingesting the shards of previous
+    submissions, while the jobs open it read-only.
+    """
+
+    def __init__(self, filename, readonly=False):
+        self.filename = filename
+        self.readonly = readonly
+        if readonly:
+            self.conn = sqlite3.connect(f"file:{filename}?mode=ro", uri=True, timeout=60)
+        else:
+            self.conn = sqlite3.connect(filename, timeout=60)
+            self._create_tables()
+
+    def _create_tables(self):
+        """Create the tables if they do not exist yet."""
+        with self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS verified ("
+                "run TEXT, targets TEXT, lineage TEXT, container TEXT, level TEXT, "
+                "PRIMARY KEY (run, targets, lineage, container))"
+            )
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS ingested (filename TEXT PRIMARY KEY, size INTEGER)"
+            )
+
+    def is_verified(self, runid, targets, lineage, container):
+        """Whether the targets of the run were loaded before with the same
+        lineage and container."""
+        cursor = self.conn.execute(
+            "SELECT 1 FROM verified WHERE run=? AND targets=? AND lineage=? AND container=?",
+            (runid, json.dumps(list(targets)), lineage, container),
+        )
+        return cursor.fetchone() is not None
+
+    def add(self, records):
+        """Add the successful load records carrying a lineage."""
+        rows = [
+            (
+                r["run"],
+                json.dumps(list(r["target"])),
+                r["lineage"],
+                r.get("container"),
+                r["level"],
+            )
+            for r in records
+            if r["kind"] == "load" and r["status"] == "ok" and r.get("lineage")
+        ]
+        with self.conn:
+            self.conn.executemany("INSERT OR IGNORE INTO verified VALUES (?, ?, ?, ?, ?)", rows)
+        return len(rows)
+
+    def ingest(self, result_folder):
+        """Add the records of all shards in the result folder which are new or
+        grew since the last time, so that interrupted submissions resume."""
+        n_added = 0
+        for filename in sorted(glob.glob(os.path.join(result_folder, "*-shards", "*.jsonl"))):
+            size = os.path.getsize(filename)
+            cursor = self.conn.execute("SELECT size FROM ingested WHERE filename=?", (filename,))
+            row = cursor.fetchone()
+            if row is not None and row[0] == size:
+                continue
+            n_added += self.add(read_shard(filename))
+            with self.conn:
+                self.conn.execute("INSERT OR REPLACE INTO ingested VALUES (?, ?)", (filename, size))
+        print(f"Ingested {n_added} verified records into {self.filename}")
+
+    def close(self):
+        self.conn.close()
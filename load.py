@@ -1,19 +1,64 @@
 import numpy as np
+import os
 import sys
-import cutax
 import time
 import json
-import ast
-from random import randint
 import configparser
 import gc
+import hashlib
+import random
+import struct
+import resource
+import threading
+import multiprocessing
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from records import write_records, classify_error
+from cache import VerificationCache
+from workqueue import WorkQueue
+from monitor import Heartbeat
+
+# Loader shared with forked workers in the worker-pool mode
+_loader = None
+
+# Levels tested by the combined jobs, in this order, the first one giving the context
+LEVELS = ["peaks", "events"]
 
 
 class Loader:
-    def __init__(self):
-        self._get_job_attr()
+    def __init__(
+        self,
+        level=None,
+        runlist=None,
+        shard_filename=None,
+        make_context=None,
+        context_owner=None,
+        located=None,
+    ):
+        # Function of the level returning the context, instead of cutax
+        self.make_context = make_context
+        if level is None:
+            self._get_job_attr()
+        else:
+            self.level = level
+            self.runlist = runlist
+            self.shard_filename = shard_filename
         self._load_configs()
-        self._get_context()
+        # The context and storage lookups can be shared with the loader of another level,
+        # the context is built on first use, so never in the parent of a pool
+        self.context_owner = context_owner
+        self._st = None
+        self._located = {} if located is None else located
+        self._diagnosed = {}
+        self._open_cache()
+        self.heartbeat = None
+        if self.shard_filename is not None:
+            self.heartbeat = Heartbeat.for_shard(self.shard_filename, self.heartbeat_interval)
+        self.pool = None
+        # Bytes read so far by the prefetch threads, not to be charged to the run being tested
+        self._prefetch_lock = threading.Lock()
+        self._prefetch_read = 0
         print("Initialization done.")
 
     def _get_job_attr(self):
@@ -23,20 +68,17 @@ class Loader:
 
         level = args[1]
         runlist_str = args[2]
-        result_filename = args[3]
-        err_filename = args[4]
+        shard_filename = args[3]
 
-        runlist = ast.literal_eval(runlist_str)
+        runlist = json.loads(runlist_str)
 
         self.level = level
         self.runlist = runlist
-        self.result_filename = result_filename
-        self.err_filename = err_filename
+        self.shard_filename = shard_filename
 
         print(f"Level: {self.level}")
         print(f"Runlist: {self.runlist}")
-        print(f"Result filename: {self.result_filename}")
-        print(f"Error filename: {self.err_filename}")
+        print(f"Shard filename: {self.shard_filename}")
 
     def _load_configs(self):
         """Load configurations from config.ini."""
@@ -53,6 +95,7 @@ class Loader:
         self.targets = targets_dict[self.level]
 
         if self.level == "peaks":
+            self.result_folder = config.get("context", "peaks_result_folder", fallback=None)
             self.output_folder = config.get(
                 "context", "peaks_output_folder", fallback="./strax_data"
             )
@@ -61,6 +104,7 @@ class Loader:
                 "computation", "allow_peaks_computation", fallback=False
             )
         elif self.level == "events":
+            self.result_folder = config.get("context", "events_result_folder", fallback=None)
             self.output_folder = config.get("context", "events_output_folder", fallback=None)
             self.storage_to_patch = config.get("context", "events_storage_to_patch", fallback=None)
             self.allow_computation = config.getboolean(
@@ -72,11 +116,64 @@ class Loader:
         self.never_save = json.loads(_never_save)
         self._reorganize_must_have()
 
+        # Number of runs loaded at the same time, 0 means one per allocated core
+        self.n_workers = config.getint("load", "n_workers", fallback=0)
+        if self.n_workers <= 0:
+            self.n_workers = int(os.environ.get("SLURM_CPUS_PER_TASK", 1))
+
+        # Validate chunk by chunk instead of building the whole run in memory
+        self.streaming = config.getboolean("load", "streaming", fallback=False)
+
+        # Check metadata and chunk files before, and maybe instead of, a full load
+        self.tiered = config.getboolean("load", "tiered", fallback=False)
+        self.tier2_fraction = config.getfloat("load", "tier2_fraction", fallback=1.0)
+        self.seed = config.getint("load", "seed", fallback=0)
+
+        # Columns needed to prove loadability for each data type, on top of time
+        self.columns = json.loads(config.get("load", "columns", fallback="{}"))
+
+        # Retry transient errors in the job, waiting retry_backoff seconds, doubled each time
+        self.retries = config.getint("load", "retries", fallback=2)
+        self.retry_backoff = config.getfloat("load", "retry_backoff", fallback=30)
+
+        # Localize the broken chunks of the data types of failed runs
+        self.diagnose = config.getboolean("load", "diagnose", fallback=False)
+
+        # Seconds between two heartbeats of the job, read by the monitor
+        self.heartbeat_interval = config.getint("load", "heartbeat_interval", fallback=60)
+
+        # Look up and read the next runs in background while testing the current one
+        self.prefetch_runs = config.getint("load", "prefetch_runs", fallback=0)
+        self.prefetch_mb = config.getfloat("load", "prefetch_mb", fallback=4000)
+
+        # Load only some chunks of each run, and all of them if any fails
+        self.sampled = config.getboolean("load", "sampled", fallback=False)
+        self.sample_chunks = config.getint("load", "sample_chunks", fallback=3)
+
+        # Load the targets of all tuples once per data kind
+        self.shared_plan = config.getboolean("load", "shared_plan", fallback=False)
+        self.plan_cache_mb = config.getfloat("load", "plan_cache_mb", fallback=1000)
+
+        # Skip targets already verified with the same lineage and container
+        self.use_cache = config.getboolean("load", "use_cache", fallback=True)
+        self.container = config.get("utilix", "container", fallback=None)
+        self.cache_filename = os.path.join(self.result_folder, "verified.sqlite")
+
         print(f"Allow computation: {self.allow_computation}")
         print(f"Must have: {self.must_have}")
         print(f"Targets: {self.targets}")
+        print(f"Columns: {self.columns}")
         print(f"Output folder: {self.output_folder}")
         print(f"Storage to patch: {self.storage_to_patch}")
+        print(f"Number of workers: {self.n_workers}")
+        print(f"Streaming: {self.streaming}")
+        print(f"Tiered: {self.tiered}, full load fraction: {self.tier2_fraction}")
+        print(f"Shared plan: {self.shared_plan}")
+        print(f"Sampled: {self.sampled}, random chunks: {self.sample_chunks}")
+        print(f"Prefetch: {self.prefetch_runs} runs, up to {self.prefetch_mb} MB")
+        print(f"Diagnose: {self.diagnose}")
+        print(f"Retries: {self.retries}, backoff: {self.retry_backoff} s")
+        print(f"Use cache: {self.use_cache}")
 
     def _reorganize_must_have(self):
         """Reorganize must_have list if allow_computation is False."""
@@ -99,8 +196,29 @@ class Loader:
         """Remove targets that should never be saved."""
         self.targets_concat = [t for t in self.targets_concat if t not in self.never_saved]
 
+    @property
+    def st(self):
+        """The context, built on first use, the one of the context owner if
+        any."""
+        if self.context_owner is not None:
+            return self.context_owner.st
+        if self._st is None:
+            self._get_context()
+        return self._st
+
     def _get_context(self):
         """Get context from cutax."""
+        if self.context_owner is not None:
+            self.context_owner._get_context()
+            return
+        if self.make_context is not None:
+            self._st = self.make_context(self.level)
+            print("Storage:", self._st.storage)
+            self._order_frontends()
+            return
+
+        import cutax
+
         if self.level == "peaks":
             # Special treatment for dali cluster, though it might have been handled by utilix already
             st = cutax.xenonnt_offline(
@@ -113,57 +231,1154 @@ class Loader:
             st = cutax.xenonnt_offline(output_folder=self.output_folder)
 
         print("Storage:", st.storage)
-        self.st = st
+        self._st = st
+        self._order_frontends()
+
+    def _order_frontends(self):
+        """Order the storage frontends by the latency measured by batch.py
+        before submission, if any, so that the fastest copy is read."""
+        if self.shard_filename is None:
+            return
+        filename = os.path.join(os.path.dirname(self.shard_filename), "frontends.json")
+        if not os.path.exists(filename):
+            return
+        with open(filename, "r") as f:
+            latency = json.load(f)
+        # Frontends never queried keep their order, after the measured ones
+        self.st.storage = sorted(
+            self.st.storage, key=lambda sf: latency.get(_frontend_name(sf), float("inf"))
+        )
+        print("Storage ordered by latency:", self.st.storage)
+
+    def _open_cache(self):
+        """Open the verification cache read-only, if there is one."""
+        self.cache = None
+        if self.use_cache and os.path.exists(self.cache_filename):
+            self.cache = VerificationCache(self.cache_filename, readonly=True)
+
+    def _lineage(self, keys):
+        """Combine the lineage hashes of the data keys of a targets tuple."""
+        return ",".join(key.lineage_hash for key in keys)
+
+    def scan_verified(self, cache):
+        """Find the runs whose targets were all verified before, in bulk, and
+        return their records."""
+        runids = [str(r).zfill(6) for r in self.runlist]
+        lineages = {runid: [] for runid in runids}
+        for targets in self.targets:
+            keys = [self.st.keys_for_runs(target, runids) for target in targets]
+            for i, runid in enumerate(runids):
+                lineages[runid].append(self._lineage([k[i] for k in keys]))
+
+        verified = {}
+        for runid in runids:
+            if all(
+                cache.is_verified(runid, targets, lineage, self.container)
+                for targets, lineage in zip(self.targets, lineages[runid])
+            ):
+                verified[runid] = [
+                    self._record(
+                        runid,
+                        "load",
+                        targets,
+                        "ok",
+                        lineage=lineage,
+                        container=self.container,
+                        cached=True,
+                    )
+                    for targets, lineage in zip(self.targets, lineages[runid])
+                ]
+        return verified
+
+    def scan_stored(self):
+        """Find the missing must_have data types of all runs in bulk, with one
+        query per data type and storage frontend instead of one per run."""
+        runids = [str(r).zfill(6) for r in self.runlist]
+        missing = {runid: [] for runid in runids}
+        # Where each data type of each run is, and the seconds per key of each frontend
+        self.locations = {runid: {} for runid in runids}
+        self.frontend_latency = {}
+        for data_type in self.must_have:
+            print(f"Scanning storage for {data_type}...")
+            keys = self.st.keys_for_runs(data_type, runids)
+            found = np.zeros(len(runids), dtype=bool)
+            for sf in self.st.storage:
+                remaining = np.where(~found)[0]
+                if not len(remaining):
+                    break
+                t0 = time.time()
+                result = sf.find_several([keys[i] for i in remaining], **self.st._find_options)
+                self.frontend_latency.setdefault(_frontend_name(sf), []).append(
+                    (time.time() - t0) / len(remaining)
+                )
+                for i, r in zip(remaining, result):
+                    if r:
+                        self.locations[runids[i]][data_type] = _local_path(sf, r[1])
+                found[remaining] = [bool(r) for r in result]
+            for i in np.where(~found)[0]:
+                missing[runids[i]].append(data_type)
+        return missing
+
+    def scan_sizes(self, cache_filename=None):
+        """Get the stored size in MB of the must_have data types of all runs
+        from their metadata, cached by data key in a json file."""
+        cache = {}
+        if cache_filename is not None and os.path.exists(cache_filename):
+            with open(cache_filename, "r") as f:
+                cache = json.load(f)
+
+        runids = [str(r).zfill(6) for r in self.runlist]
+        sizes = dict.fromkeys(runids, 0.0)
+        for data_type in self.must_have:
+            print(f"Scanning sizes of {data_type}...")
+            keys = self.st.keys_for_runs(data_type, runids)
+            for runid, key in zip(runids, keys):
+                key = str(key)
+                if key not in cache:
+                    try:
+                        metadata = self.st.get_metadata(runid, data_type)
+                    except Exception as e:
+                        print(f"Cannot get the size of {data_type} for {runid}: {e}")
+                        continue
+                    cache[key] = sum(chunk["nbytes"] for chunk in metadata["chunks"]) / 1e6
+                sizes[runid] += cache[key]
+
+        if cache_filename is not None:
+            with open(cache_filename, "w") as f:
+                json.dump(cache, f)
+        return sizes
+
+    def _start_measure(self):
+        """Start measuring wall time, bytes read and peak RSS of a check."""
+        try:
+            # Reset the peak RSS of this process, only possible on linux
+            with open("/proc/self/clear_refs", "w") as f:
+                f.write("5")
+        except OSError:
+            pass
+        return time.time(), _bytes_read(), self._prefetch_read
+
+    def _stop_measure(self, start, n_chunks=None):
+        """Get the metrics of a check since its start, without the bytes read
+        meanwhile by the prefetch threads of the same process."""
+        t0, bytes0, prefetch0 = start
+        elapsed = time.time() - t0
+        bytes_read = None
+        if bytes0 is not None:
+            bytes_read = max(_bytes_read() - bytes0 - (self._prefetch_read - prefetch0), 0)
+        return {
+            "time": round(elapsed, 3),
+            "bytes_read": bytes_read,
+            "peak_rss": _peak_rss(),
+            "n_chunks": n_chunks,
+            "mb_per_s": (
+                round(bytes_read / 1e6 / elapsed, 3) if bytes_read is not None and elapsed else None
+            ),
+        }
+
+    def _record(self, runid, kind, target, status, error=None, start=None, **kwargs):
+        """Make a structured record of a single check, with its metrics if
+        measured, and the category of its error if it failed."""
+        if isinstance(error, Exception):
+            kwargs.setdefault("category", classify_error(error))
+            error = str(error)
+        elif status == "missing":
+            kwargs.setdefault("category", "missing")
+        record = {
+            "run": runid,
+            "level": self.level,
+            "kind": kind,
+            "target": target,
+            "status": status,
+            "error": error,
+            "time": None,
+        }
+        if start is not None:
+            record.update(self._stop_measure(start, kwargs.pop("n_chunks", None)))
+        record.update(kwargs)
+        return record
+
+    def _locate(self, runid, data_type):
+        """Find the first storage frontend holding a data type of a run, like
+        Context.is_stored does, and the backend key there, or None and None if
+        none of them has it. Lookups are cached for the lifetime of the job."""
+        if (runid, data_type) in self._located:
+            return self._located[runid, data_type]
+        located = None, None
+        key = self.st.key_for(runid, data_type)
+        for sf in self.st.storage:
+            result = sf.find_several([key], **self.st._find_options)[0]
+            if result:
+                located = sf.__class__.__name__, _local_path(sf, result[1])
+                break
+        self._located[runid, data_type] = located
+        return located
+
+    def _run_mode(self, runid):
+        """Get the run mode from the run database, if available."""
+        try:
+            return self._retry(self.st.run_metadata, runid, projection=("mode",))["mode"]
+        except Exception as e:
+            print(f"Cannot get the run mode of {runid}: {e}")
+            return None
+
+    def _test_run(self, r, prefetched=None):
+        """Test a single run and return the records of all checks, reusing
+        the storage lookups of the prefetch if any."""
+        runid = str(r).zfill(6)
+        print("--------------------")
+        print("Runid:", runid)
+
+        if prefetched is not None:
+            mode = prefetched["mode"]
+            records = self._check_storage(runid, mode, prefetched["located"])
+        else:
+            mode = self._run_mode(runid)
+            records = self._check_storage(runid, mode)
+        if any(record["status"] != "ok" for record in records):
+            return records
+
+        if self.tiered:
+            records += self._check_metadata(records, mode)
+            if any(record["status"] != "ok" for record in records):
+                if self.diagnose:
+                    failed = [r["target"] for r in records if r["status"] != "ok"]
+                    records += [self._diagnose(runid, [data_type], mode) for data_type in failed]
+                return records
+            # Only a sample of the runs passing the first tier is fully loaded
+            if random.Random(f"{self.seed}-{runid}").random() >= self.tier2_fraction:
+                print("Not sampled for a full load, relying on the metadata check.")
+                for targets in self.targets:
+                    records.append(self._record(runid, "load", targets, "ok", tier=1, mode=mode))
+                return records
+
+        records += self._load_targets(runid, mode)
+        return records
+
+    def _check_storage(self, runid, mode, located=None):
+        """Check that all must_have data types of a run are stored."""
+        records = []
+        for data_type in self.must_have:
+            start = self._start_measure()
+            try:
+                if located is not None and data_type in located:
+                    frontend, location = located[data_type]
+                else:
+                    frontend, location = self._retry(self._locate, runid, data_type)
+            except Exception as e:
+                print(f"Cannot look up {data_type}: {e}")
+                records.append(
+                    self._record(runid, "storage", data_type, "failed", e, start=start, mode=mode)
+                )
+                continue
+            status = "ok" if frontend is not None else "missing"
+            n_chunks = None
+            if frontend is None:
+                print(f"{data_type} not stored!")
+            else:
+                n_chunks = self._n_chunks(runid, [data_type])
+            records.append(
+                self._record(
+                    runid,
+                    "storage",
+                    data_type,
+                    status,
+                    start=start,
+                    n_chunks=n_chunks,
+                    frontend=frontend,
+                    location=location,
+                    mode=mode,
+                    prefetched=located is not None,
+                )
+            )
+        return records
+
+    def _prefetch(self, r):
+        """Look up the storage of a run and read its chunk files once, so that
+        they are in the page cache when the run is tested, within the
+        prefetch memory budget."""
+        runid = str(r).zfill(6)
+        prefetched = {"mode": self._run_mode(runid), "located": {}, "nbytes": 0}
+        for data_type in self.must_have:
+            # A failed lookup is retried and recorded when the run is tested
+            try:
+                prefetched["located"][data_type] = self._locate(runid, data_type)
+            except Exception:
+                pass
+
+        for data_type, (frontend, location) in prefetched["located"].items():
+            if location is None:
+                continue
+            try:
+                chunks = self.st.get_metadata(runid, data_type)["chunks"]
+            except Exception:
+                continue
+            for chunk in chunks:
+                filename = _chunk_path(frontend, location, chunk)
+                if filename is None or not os.path.isfile(filename):
+                    continue
+                with self._prefetch_lock:
+                    if self._prefetched_nbytes + chunk["filesize"] > self.prefetch_mb * 1e6:
+                        return prefetched
+                    self._prefetched_nbytes += chunk["filesize"]
+                prefetched["nbytes"] += chunk["filesize"]
+                with open(filename, "rb") as f:
+                    while True:
+                        n = len(f.read(1 << 22))
+                        if not n:
+                            break
+                        with self._prefetch_lock:
+                            self._prefetch_read += n
+        return prefetched
+
+    def _check_metadata(self, storage_records, mode):
+        """First tier of the integrity check, reading only the metadata and
+        the chunk file headers of the stored data types."""
+        records = []
+        for storage_record in storage_records:
+            runid = storage_record["run"]
+            data_type = storage_record["target"]
+            start = self._start_measure()
+            try:
+                n_chunks = self._retry(
+                    self._check_chunks,
+                    runid,
+                    data_type,
+                    storage_record["frontend"],
+                    storage_record["location"],
+                )
+                records.append(
+                    self._record(
+                        runid,
+                        "integrity",
+                        data_type,
+                        "ok",
+                        start=start,
+                        n_chunks=n_chunks,
+                        mode=mode,
+                    )
+                )
+            except Exception as e:
+                print(f"Integrity check of {data_type} failed: {e}")
+                records.append(
+                    self._record(runid, "integrity", data_type, "failed", e, start=start, mode=mode)
+                )
+        return records
+
+    def _check_chunks(self, runid, data_type, frontend, location):
+        """Check that the chunks of a data type are contiguous and consistent
+        with their time ranges, and for backends on a local filesystem, that
+        the chunk files exist with the expected sizes and headers."""
+        metadata = self.st.get_metadata(runid, data_type)
+        chunks = metadata["chunks"]
+        if not chunks:
+            raise ValueError(f"{data_type} has no chunks")
+        for chunk, next_chunk in zip(chunks[:-1], chunks[1:]):
+            if chunk["end"] != next_chunk["start"]:
+                raise ValueError(
+                    f"Chunk {chunk['chunk_i']} of {data_type} ends at {chunk['end']}, but the "
+                    f"next one starts at {next_chunk['start']}"
+                )
+        for chunk in chunks:
+            if chunk["start"] > chunk["end"]:
+                raise ValueError(f"Chunk {chunk['chunk_i']} of {data_type} ends before it starts")
+            if chunk.get("n") and chunk.get("first_time") is not None:
+                if chunk["first_time"] < chunk["start"] or chunk["last_time"] > chunk["end"]:
+                    raise ValueError(
+                        f"Chunk {chunk['chunk_i']} of {data_type} has data outside of "
+                        f"[{chunk['start']}, {chunk['end']}]"
+                    )
+
+        if location is None:
+            return len(chunks)
+        for chunk in chunks:
+            filename = _chunk_path(frontend, location, chunk)
+            if filename is not None:
+                _check_chunk_file(filename, chunk, metadata.get("compressor"))
+        return len(chunks)
+
+    def _load_targets(self, runid, mode):
+        """Load all targets of a run, the second tier of the integrity
+        check."""
+        records = []
+        pending = []
+        for targets in self.targets:
+            try:
+                lineage = self._lineage([self.st.key_for(runid, target) for target in targets])
+            except Exception as e:
+                print(f"Error: {e}")
+                records.append(self._record(runid, "load", targets, "failed", e, mode=mode))
+                continue
+            info = dict(lineage=lineage, container=self.container, mode=mode)
+            if self.cache is not None and self.cache.is_verified(
+                runid, targets, lineage, self.container
+            ):
+                print(f"{targets} already verified.")
+                records.append(self._record(runid, "load", targets, "ok", cached=True, **info))
+                continue
+            pending.append((targets, info))
+
+        if self.sampled:
+            for targets, info in pending:
+                records += self._load_sampled(runid, targets, info)
+        elif self.shared_plan and len(pending) > 1:
+            records += self._load_shared(runid, pending, mode)
+        else:
+            for targets, info in pending:
+                records.append(self._load_one(runid, targets, info))
+
+        if self.diagnose:
+            for record in list(records):
+                if (
+                    record["kind"] == "load"
+                    and record["status"] == "failed"
+                    and record.get("category") in ["corruption", "other"]
+                ):
+                    records.append(self._diagnose(runid, record["target"], mode))
+        return records
+
+    def _diagnose(self, runid, targets, mode):
+        """Find which chunks of which must_have data types the targets depend
+        on are unreadable or inconsistent, walking them in lineage order,
+        lowest first, loading them chunk by chunk and stopping at the first
+        broken one."""
+        start = self._start_measure()
+        print(f"Diagnosing {targets}...")
+        try:
+            # Only the data types checked by the load test, not all the way down to raw_records
+            data_types = set(targets)
+            for target in targets:
+                lineage = self.st.key_for(runid, target).lineage
+                data_types |= {d for d in self.must_have if d in lineage}
+            # A data type has fewer data types in its lineage than the ones depending on it
+            lineage_order = sorted(
+                data_types, key=lambda d: (len(self.st.key_for(runid, d).lineage), d)
+            )
+            report = []
+            for data_type in lineage_order:
+                frontend, location = self._locate(runid, data_type)
+                if frontend is None:
+                    continue
+                # Tuples of the same run often share data types
+                if (runid, data_type) not in self._diagnosed:
+                    self._diagnosed[runid, data_type] = self._diagnose_chunks(
+                        runid, data_type, frontend, location
+                    )
+                n_chunks, broken = self._diagnosed[runid, data_type]
+                report.append(
+                    {
+                        "data_type": data_type,
+                        "lineage_hash": self.st.key_for(runid, data_type).lineage_hash,
+                        "frontend": frontend,
+                        "n_chunks": n_chunks,
+                        "broken_chunks": broken,
+                    }
+                )
+                # The data types above depend on the broken one
+                if broken:
+                    break
+        except Exception as e:
+            print(f"Diagnosis failed: {e}")
+            return self._record(runid, "diagnosis", targets, "failed", e, start=start, mode=mode)
+
+        lowest_broken = next((d["data_type"] for d in report if d["broken_chunks"]), None)
+        print(f"Lowest broken data type: {lowest_broken}")
+        return self._record(
+            runid,
+            "diagnosis",
+            targets,
+            "broken" if lowest_broken else "ok",
+            start=start,
+            data_types=report,
+            lowest_broken=lowest_broken,
+            mode=mode,
+        )
+
+    def _diagnose_chunks(self, runid, data_type, frontend, location):
+        """Load a stored data type chunk by chunk and return its number of
+        chunks and the ones failing, with their errors."""
+        try:
+            metadata = self.st.get_metadata(runid, data_type)
+        except Exception as e:
+            return None, [{"chunk_i": None, "error": str(e), "category": classify_error(e)}]
+        chunks = metadata["chunks"]
+        broken = []
+        for i, chunk in enumerate(chunks):
+            time_range = (chunk["start"], chunk["end"])
+            try:
+                if i and chunks[i - 1]["end"] != chunk["start"]:
+                    raise ValueError(
+                        f"Chunk starts at {chunk['start']}, but the previous one ends at "
+                        f"{chunks[i - 1]['end']}"
+                    )
+                filename = None if location is None else _chunk_path(frontend, location, chunk)
+                if filename is not None:
+                    _check_chunk_file(filename, chunk, metadata.get("compressor"))
+                data = self.st.get_array(
+                    runid,
+                    data_type,
+                    keep_columns=("time",),
+                    time_range=time_range,
+                    progress_bar=False,
+                )
+                if np.any(np.diff(data["time"]) < 0):
+                    raise ValueError("Chunk is not sorted by time")
+                if len(data) and (
+                    data["time"][0] < time_range[0] or data["time"][-1] > time_range[1]
+                ):
+                    raise ValueError(f"Chunk has data outside of {time_range}")
+                if chunk.get("n") and not len(data):
+                    raise ValueError(f"Chunk is empty but has {chunk['n']} items in its metadata")
+                del data
+            except Exception as e:
+                broken.append(
+                    {
+                        "chunk_i": chunk.get("chunk_i", i),
+                        "start": chunk["start"],
+                        "end": chunk["end"],
+                        "error": str(e),
+                        "category": classify_error(e),
+                    }
+                )
+        gc.collect()
+        return len(chunks), broken
+
+    def _retry(self, func, *args, **kwargs):
+        """Call func, retrying with exponential backoff as long as it fails
+        with a transient error, up to retries times."""
+        for attempt in range(self.retries + 1):
+            try:
+                return func(*args, **kwargs)
+            except Exception as e:
+                if attempt == self.retries or classify_error(e) != "transient":
+                    raise
+                delay = self.retry_backoff * 2**attempt
+                print(f"Transient error: {e}, retrying in {delay} s...")
+                time.sleep(delay)
+
+    def _keep_columns(self, targets):
+        """Columns to materialize when loading targets: time plus the ones
+        configured for each of them, or None to load all columns if none of
+        them has columns configured."""
+        if not any(self.columns.get(target) for target in targets):
+            return None
+        keep_columns = ["time"]
+        for target in targets:
+            keep_columns += [c for c in self.columns.get(target, []) if c not in keep_columns]
+        return tuple(keep_columns)
+
+    def _load(self, runid, targets, keep=False):
+        """Load targets of a run, chunk by chunk if streaming, and return the
+        number of chunks if known and the data if asked to keep it."""
+        n_chunks = None
+        data = None
+        if self.streaming:
+            n_chunks = self._stream_targets(runid, targets)
+            print(f"{n_chunks} chunks validated.")
+        else:
+            data = self.st.get_array(runid, targets, keep_columns=self._keep_columns(targets))
+            n_chunks = self._n_chunks(runid, targets)
+            if not keep:
+                del data
+                data = None
+        gc.collect()
+        return n_chunks, data
+
+    def _n_chunks(self, runid, targets):
+        """Number of chunks of the stored targets of a run, from their
+        metadata, or None if none of them is stored."""
+        n_chunks = None
+        for target in targets:
+            try:
+                n = len(self.st.get_metadata(runid, target)["chunks"])
+            except Exception:
+                continue
+            n_chunks = max(n_chunks or 0, n)
+        return n_chunks
+
+    def _load_one(self, runid, targets, info):
+        """Load a single targets tuple of a run."""
+        start = self._start_measure()
+        try:
+            print(f"Loading {targets}...")
+            n_chunks, _ = self._retry(self._load, runid, targets)
+            print(f"{targets} loaded. ")
+            return self._record(
+                runid, "load", targets, "ok", start=start, n_chunks=n_chunks, **info
+            )
+        except Exception as e:
+            print(f"Error: {e}")
+            return self._record(runid, "load", targets, "failed", e, start=start, mode=info["mode"])
+
+    def _load_sampled(self, runid, targets, info):
+        """Load only the first, the last and sample_chunks random chunks of a
+        targets tuple, with the chunks of a stored data type as reference,
+        and escalate to a full load if any of them fails or looks
+        suspicious."""
+        stored = [target for target in targets if target in self.must_have]
+        reference = stored[0] if stored else self.must_have[0]
+        start = self._start_measure()
+        try:
+            chunks = self.st.get_metadata(runid, reference)["chunks"]
+            rng = random.Random(f"{self.seed}-{runid}-{'-'.join(targets)}")
+            middle = list(range(1, len(chunks) - 1))
+            indices = sorted(
+                {0, len(chunks) - 1} | set(rng.sample(middle, min(self.sample_chunks, len(middle))))
+            )
+            coverage = {
+                "chunks": round(len(indices) / len(chunks), 4),
+                "bytes": round(
+                    sum(chunks[i]["nbytes"] for i in indices)
+                    / max(sum(c["nbytes"] for c in chunks), 1),
+                    4,
+                ),
+            }
+            print(f"Loading chunks {indices} of {len(chunks)} of {targets}...")
+            for i in indices:
+                time_range = (chunks[i]["start"], chunks[i]["end"])
+                data = self.st.get_array(
+                    runid,
+                    targets,
+                    keep_columns=self._keep_columns(targets),
+                    time_range=time_range,
+                    progress_bar=False,
+                )
+                if np.any(np.diff(data["time"]) < 0):
+                    raise ValueError(f"Chunk {i} of {targets} is not sorted by time")
+                if len(data) and (
+                    data["time"][0] < time_range[0] or data["time"][-1] > time_range[1]
+                ):
+                    raise ValueError(f"Chunk {i} of {targets} has data outside of {time_range}")
+                if reference in targets and chunks[i].get("n") and not len(data):
+                    raise ValueError(f"Chunk {i} of {targets} is empty but {reference} is not")
+                del data
+            gc.collect()
+        except Exception as e:
+            print(f"Sampled load failed: {e}, escalating to a full load.")
+            record = self._record(
+                runid, "sample", targets, "escalated", e, start=start, mode=info["mode"]
+            )
+            return [record, self._load_one(runid, targets, info)]
+
+        print(f"{targets} sampled, coverage: {coverage}")
+        return [
+            self._record(
+                runid,
+                "load",
+                targets,
+                "ok",
+                start=start,
+                n_chunks=len(indices),
+                sampled=True,
+                coverage=coverage,
+                mode=info["mode"],
+            )
+        ]
+
+    def _plan(self, runid, pending):
+        """Stored data types each targets tuple of a run is read from: its
+        stored targets, and for the others the stored data types of their
+        lineage which no other stored one of it depends on."""
+        lineages = {}
+
+        def lineage(data_type):
+            if data_type not in lineages:
+                lineages[data_type] = self.st.key_for(runid, data_type).lineage
+            return lineages[data_type]
+
+        plan = {}
+        for targets, _ in pending:
+            depends_on = set()
+            for target in targets:
+                if self._locate(runid, target)[0] is not None:
+                    depends_on.add(target)
+                    continue
+                stored = [d for d in lineage(target) if self._locate(runid, d)[0] is not None]
+                depends_on |= {
+                    d for d in stored if not any(d in lineage(e) for e in stored if e != d)
+                }
+            plan[tuple(targets)] = sorted(depends_on)
+        return plan
+
+    def _load_shared(self, runid, pending, mode):
+        """Read each stored data type the targets tuples of a run depend on
+        once, from a plan built from their lineage, and validate each tuple
+        against these shared loads: all of them must be readable, and its
+        stored targets of the same data kind aligned in time. The times are
+        kept in a cache of at most plan_cache_mb MB.
+
+        Tuples depending on a failed shared load fail with its error. Tuples
+        which cannot be planned, depend on no stored data type or whose times
+        were evicted are loaded on their own.
+        """
+        try:
+            plan = self._plan(runid, pending)
+            # Stored targets of the same data kind are merged when loaded together
+            kinds = {
+                target: self.st.get_single_plugin(runid, target).data_kind_for(target)
+                for targets, depends_on in plan.items()
+                for target in targets
+                if target in depends_on
+            }
+        except Exception as e:
+            print(f"Cannot plan the loads of {runid}: {e}")
+            return [self._load_one(runid, targets, info) for targets, info in pending]
+        print(f"Load plan: {plan}")
+
+        records = []
+        cache = _BoundedCache(self.plan_cache_mb)
+        failed = {}
+        for data_type in sorted({d for depends_on in plan.values() for d in depends_on}):
+            start = self._start_measure()
+            try:
+                print(f"Loading {data_type}...")
+                n_chunks, data = self._retry(self._load, runid, [data_type], keep=True)
+                if data is not None:
+                    if np.any(np.diff(data["time"]) < 0):
+                        raise ValueError(f"{data_type} is not sorted by time")
+                    # Only the times of the targets are needed to validate the tuples
+                    if data_type in kinds:
+                        cache.put(data_type, data["time"].copy())
+                    del data
+                gc.collect()
+                status, error = "ok", None
+            except Exception as e:
+                print(f"Error: {e}")
+                n_chunks = None
+                status, error = "failed", e
+                failed[data_type] = e
+            records.append(
+                self._record(
+                    runid,
+                    "plan",
+                    data_type,
+                    status,
+                    error,
+                    start=start,
+                    n_chunks=n_chunks,
+                    mode=mode,
+                )
+            )
+
+        for targets, info in pending:
+            depends_on = plan[tuple(targets)]
+            broken = [d for d in depends_on if d in failed]
+            if broken:
+                # Not read again, the error of the shared load is the one of the tuple
+                error = failed[broken[0]]
+                records.append(
+                    self._record(
+                        runid,
+                        "load",
+                        targets,
+                        "failed",
+                        f"{broken[0]} failed to load: {error}",
+                        mode=mode,
+                        category=classify_error(error),
+                    )
+                )
+                continue
+            if not depends_on:
+                records.append(self._load_one(runid, targets, info))
+                continue
+            same_kind = {}
+            for target in targets:
+                if target in depends_on:
+                    same_kind.setdefault(kinds[target], []).append(target)
+            # Streamed loads keep no times, only their readability is validated
+            groups = [] if self.streaming else [g for g in same_kind.values() if len(g) > 1]
+            times = {target: cache.get(target) for group in groups for target in group}
+            if any(t is None for t in times.values()):
+                records.append(self._load_one(runid, targets, info))
+                continue
+            misaligned = [
+                group
+                for group in groups
+                if any(not np.array_equal(times[t], times[group[0]]) for t in group[1:])
+            ]
+            if misaligned:
+                error = f"{misaligned[0]} are not aligned in time"
+                records.append(
+                    self._record(
+                        runid, "load", targets, "failed", error, mode=mode, category="corruption"
+                    )
+                )
+                continue
+            print(f"{targets} validated from the shared loads of {depends_on}.")
+            records.append(
+                self._record(
+                    runid, "load", targets, "ok", shared=True, depends_on=depends_on, **info
+                )
+            )
+        return records
+
+    def _stream_targets(self, runid, targets):
+        """Iterate over targets chunk by chunk, so that only one chunk is
+        resident at a time, and validate each of them."""
+        n_chunks = 0
+        last_end = None
+        for chunk in self.st.get_iter(
+            runid, targets, keep_columns=self._keep_columns(targets), progress_bar=False
+        ):
+            if last_end is not None and chunk.start != last_end:
+                raise ValueError(
+                    f"Chunk {n_chunks} of {targets} starts at {chunk.start}, "
+                    f"but the previous one ends at {last_end}"
+                )
+            time_ = chunk.data["time"]
+            if len(time_) and (time_[0] < chunk.start or time_[-1] > chunk.end):
+                raise ValueError(
+                    f"Chunk {n_chunks} of {targets} has data outside of "
+                    f"[{chunk.start}, {chunk.end}]"
+                )
+            if np.any(np.diff(time_) < 0):
+                raise ValueError(f"Chunk {n_chunks} of {targets} is not sorted by time")
+            last_end = chunk.end
+            n_chunks += 1
+            del chunk, time_
+        return n_chunks
+
+    def _write_result(self, records):
+        """Append the records of a single run to the shard of this job."""
+        write_records(self.shard_filename, records)
+        if self.heartbeat is not None:
+            self.heartbeat.update(records)
+        if all(record["status"] == "ok" for record in records):
+            print(f"{records[0]['run']} successful!")
 
     def loadtest(self):
         """
         Perform load test step by step:
         1. Check if all must_have data types are stored
         2. Load targets
-        3. Write to result file if successful
-        4. Write to error file if failed
+        3. Write the records of all checks to the shard of this job
+        Runs are distributed over a pool of workers if n_workers > 1.
         """
-        for r in self.runlist:
-            runid = str(r).zfill(6)
-            print("--------------------")
-            print("Runid:", runid)
-
-            is_stored = True
-            missing_datatypes = []
-            for data_type in self.must_have:
-                if not self.st.is_stored(runid, data_type):
-                    is_stored = False
-                    print(f"{data_type} not stored!")
-                    missing_datatypes.append(data_type)
-
-            if not is_stored:
-                time.sleep(randint(1, 5))
-                with open(self.err_filename, "a") as f:
-                    f.write(f"{runid} failed because of missing {missing_datatypes}\n\n")
-                continue
+        if self.heartbeat is not None:
+            self.heartbeat.start(len(self.runlist))
+        if min(self.n_workers, len(self.runlist)) > 1:
+            self._loadtest_parallel()
+        elif self.prefetch_runs > 0:
+            self._loadtest_prefetched()
+        else:
+            for r in self.runlist:
+                self._write_result(self._test_run(r))
 
-            all_loaded = True
-            for targets in self.targets:
+    def _loadtest_prefetched(self):
+        """Test runs one by one, while the storage lookups and chunk reads of
+        the next prefetch_runs runs already happen in background threads."""
+        # Build the context before the threads could each build their own
+        self.st
+        self._prefetched_nbytes = 0
+        runlist = deque(self.runlist)
+        futures = deque()
+        with ThreadPoolExecutor(max_workers=self.prefetch_runs) as executor:
+            while runlist or futures:
+                while runlist and len(futures) <= self.prefetch_runs:
+                    r = runlist.popleft()
+                    futures.append((r, executor.submit(self._prefetch, r)))
+                r, future = futures.popleft()
                 try:
-                    print(f"Loading {targets}...")
-                    data = self.st.get_array(runid, targets, keep_columns=("time"))
-                    del data
-                    gc.collect()
-                    time.sleep(randint(1, 5))
-                    print(f"{targets} loaded. ")
+                    prefetched = future.result()
                 except Exception as e:
-                    all_loaded = False
-                    print(f"Error: {e}")
-                    with open(self.err_filename, "a") as f:
-                        f.write(f"{runid} failed because of {e}\n\n")
-                    continue
-            if all_loaded:
-                with open(self.result_filename, "a") as f:
-                    f.write(f"{runid}\n")
-                print(f"{runid} successful!")
+                    print(f"Prefetch of {r} failed: {e}")
+                    prefetched = None
+                self._write_result(self._test_run(r, prefetched))
+                if prefetched is not None:
+                    with self._prefetch_lock:
+                        self._prefetched_nbytes -= prefetched["nbytes"]
+
+    def _loadtest_parallel(self):
+        """Load runs at the same time on a pool of forked workers, while only
+        the main process writes to the shard.
+
+        The pool is kept for the following calls.
+        """
+        global _loader
+        _loader = self
+        if self.pool is None:
+            self.pool = self._new_pool(min(self.n_workers, len(self.runlist)))
+        futures = {self.pool.submit(_test_run_in_worker, r): r for r in self.runlist}
+        unfinished = []
+        for future in as_completed(futures):
+            try:
+                self._write_result(future.result())
+            except BrokenProcessPool:
+                unfinished.append(futures[future])
+            except Exception as e:
+                runid = str(futures[future]).zfill(6)
+                print(f"Test of {runid} failed: {e}")
+                self._write_result([self._record(runid, "job", "worker", "failed", e)])
+        if unfinished:
+            # A killed worker breaks the whole pool, without telling which run killed it
+            self.pool.shutdown(wait=False)
+            self.pool = None
+            print(f"A worker was killed, testing the {len(unfinished)} unfinished runs one by one.")
+            self._loadtest_isolated(unfinished)
+
+    def _loadtest_isolated(self, runlist):
+        """Test runs one by one in a single worker, so that a killed worker
+        is attributed to its run, recorded as oom if the kernel killed it for
+        memory."""
+        pool = None
+        for r in runlist:
+            if pool is None:
+                pool = self._new_pool(1)
+            oom_kills = _oom_kills()
+            try:
+                self._write_result(pool.submit(_test_run_in_worker, r).result())
+            except BrokenProcessPool:
+                pool.shutdown(wait=False)
+                pool = None
+                runid = str(r).zfill(6)
+                category = "killed"
+                if oom_kills is not None and _oom_kills() > oom_kills:
+                    category = "oom"
+                print(f"The worker testing {runid} was killed ({category}).")
+                error = f"the worker testing {runid} was killed"
+                self._write_result(
+                    [self._record(runid, "job", "worker", "killed", error, category=category)]
+                )
+            except Exception as e:
+                runid = str(r).zfill(6)
+                print(f"Test of {runid} failed: {e}")
+                self._write_result([self._record(runid, "job", "worker", "failed", e)])
+        if pool is not None:
+            pool.shutdown()
+
+    def _new_pool(self, n_workers):
+        """Pool of forked workers, each one rebuilding the context."""
+        return ProcessPoolExecutor(
+            n_workers, mp_context=multiprocessing.get_context("fork"), initializer=_init_worker
+        )
+
+    def pilot(self, queue):
+        """Pull chunks of runs from the work queue until it is empty, so that
+        the context is built once for all of them."""
+        while True:
+            name, runlist = queue.claim()
+            if name is None:
+                break
+            print(f"Claimed {name} with {len(runlist)} runs.")
+            self.runlist = runlist
+            self.loadtest()
+            queue.done(name)
+        print("Work queue is empty.")
+
+    def close(self):
+        """Shut down the pool of workers, if any, and mark the job as
+        finished."""
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+        if self.heartbeat is not None:
+            self.heartbeat.finish()
+
+
+class CombinedLoader:
+    """Load test of all levels in the same job, with one loader per level
+    sharing the context and the storage lookups of the first one."""
+
+    def __init__(self, runlist=None, shard_filename=None, make_context=None):
+        self.level = "both"
+        self.runlist = runlist
+        self.shard_filename = shard_filename
+        self.loaders = []
+        located = {}
+        for level in LEVELS:
+            loader = Loader(
+                level=level,
+                runlist=runlist,
+                shard_filename=shard_filename,
+                make_context=make_context,
+                context_owner=self.loaders[0] if self.loaders else None,
+                located=located,
+            )
+            self.loaders.append(loader)
+
+    def loadtest(self):
+        """Load test the runlist level by level, into the same shard."""
+        for loader in self.loaders:
+            print(f"Testing level {loader.level}...")
+            loader.runlist = self.runlist
+            loader.loadtest()
+
+    # Only needs runlist and loadtest, which both loaders have
+    pilot = Loader.pilot
+
+    def close(self):
+        for loader in self.loaders:
+            loader.close()
+
+
+def make_loader(level, runlist, shard_filename=None, make_context=None):
+    """Get the loader of a level, or the combined loader of all levels for
+    level both."""
+    if level == "both":
+        return CombinedLoader(runlist, shard_filename, make_context)
+    return Loader(
+        level=level, runlist=runlist, shard_filename=shard_filename, make_context=make_context
+    )
+
+
+class _BoundedCache:
+    """Least recently used cache of arrays, bounded in MB."""
+
+    def __init__(self, max_mb):
+        self.max_nbytes = max_mb * 1e6
+        self.nbytes = 0
+        self.items = OrderedDict()
+
+    def put(self, key, data):
+        if data is None or data.nbytes > self.max_nbytes:
+            return
+        self.items[key] = data
+        self.nbytes += data.nbytes
+        while self.nbytes > self.max_nbytes:
+            _, evicted = self.items.popitem(last=False)
+            self.nbytes -= evicted.nbytes
+
+    def get(self, key):
+        if key not in self.items:
+            return None
+        self.items.move_to_end(key)
+        return self.items[key]
+
+
+# Magic numbers at the start of the chunk files of each compressor
+_MAGIC = {"zstd": b"\x28\xb5\x2f\xfd", "lz4": b"\x04\x22\x4d\x18", "bz2": b"BZh"}
+
+
+def _frontend_name(sf):
+    """Name of a storage frontend, telling apart the ones of the same class
+    by their path."""
+    return f"{sf.__class__.__name__}:{getattr(sf, 'path', '')}"
+
+
+def _rucio_path(root, did):
+    """Local path of a rucio DID, in the layout of the rucio local storage
+    of straxen."""
+    scope, name = did.split(":")
+    md5 = hashlib.md5(did.encode("utf-8")).hexdigest()
+    return os.path.join(root, scope, md5[0:2], md5[2:4], name)
+
+
+def _local_path(sf, backend_key):
+    """Local path of the data found by a storage frontend, the backend key
+    being a DID for the rucio local frontend and a path for the others."""
+    backend_key = str(backend_key)
+    if sf.__class__.__name__ == "RucioLocalFrontend" and ":" in backend_key:
+        return _rucio_path(sf.path, backend_key)
+    return backend_key
+
+
+def _chunk_path(frontend, location, chunk):
+    """Local path of the file of a chunk, or None if the data is not on a
+    local filesystem. Each chunk of the rucio local storage is a DID of its
+    own, in its own folder."""
+    if not chunk.get("filename"):
+        return None
+    if frontend == "RucioLocalFrontend":
+        # The location is the path of the DID of the data type, see _rucio_path
+        root, scope, _, _, _ = location.rsplit(os.sep, 4)
+        if not os.path.isdir(root):
+            return None
+        return _rucio_path(root, f"{scope}:{chunk['filename']}")
+    if not os.path.isdir(location):
+        return None
+    return os.path.join(location, chunk["filename"])
+
+
+def _check_chunk_file(filename, chunk, compressor):
+    """Check that the file of a chunk exists with the expected size and
+    header."""
+    if not os.path.exists(filename):
+        raise ValueError(f"Chunk file {filename} is missing")
+    filesize = os.path.getsize(filename)
+    if "filesize" in chunk and filesize != chunk["filesize"]:
+        raise ValueError(
+            f"Chunk file {filename} has {filesize} bytes instead of {chunk['filesize']}"
+        )
+    _check_header(filename, compressor, chunk)
+
+
+def _check_header(filename, compressor, chunk):
+    """Check the header of a compressed chunk file against its metadata."""
+    with open(filename, "rb") as f:
+        header = f.read(16)
+    if compressor == "blosc":
+        # Blosc header holds the uncompressed and compressed sizes
+        nbytes, _, cbytes = struct.unpack("<III", header[4:16])
+        if cbytes != chunk.get("filesize", cbytes) or nbytes != chunk.get("nbytes", nbytes):
+            raise ValueError(f"Header of {filename} does not match its metadata")
+    elif compressor in _MAGIC and not header.startswith(_MAGIC[compressor]):
+        raise ValueError(f"Header of {filename} is not a valid {compressor} header")
+
+
+def _bytes_read():
+    """Bytes read by this process so far, from any filesystem, or None if not
+    available."""
+    try:
+        with open("/proc/self/io", "r") as f:
+            for line in f:
+                if line.startswith("rchar:"):
+                    return int(line.split()[1])
+    except OSError:
+        return None
+
+
+def _peak_rss():
+    """Peak resident memory in MB of this process since the last reset."""
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def _oom_kills():
+    """Number of processes killed for memory in the cgroup of this job, from
+    cgroup v2, or None if not available."""
+    try:
+        with open("/proc/self/cgroup", "r") as f:
+            path = f.read().strip().split(":")[-1]
+        with open(f"/sys/fs/cgroup{path}/memory.events", "r") as f:
+            for line in f:
+                if line.startswith("oom_kill "):
+                    return int(line.split()[1])
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def _init_worker():
+    """Rebuild the context, the shared one for the loaders of a combined job,
+    and the cache connection in each worker, since database clients are not
+    fork-safe."""
+    _loader._get_context()
+    _loader._open_cache()
+
+
+def _test_run_in_worker(r):
+    """Test a single run in a worker of the pool."""
+    return _loader._test_run(r)
 
 
 if __name__ == "__main__":
-    loader = Loader()
-    loader.loadtest()
+    if sys.argv[1] == "pilot":
+        # python load.py pilot <level> <queue_dir> <shard_filename>
+        _, _, level, queue_dir, shard_filename = sys.argv
+        loader = make_loader(level, [], shard_filename)
+        loader.pilot(WorkQueue(queue_dir))
+    elif sys.argv[1] == "both":
+        # python load.py both <runlist> <shard_filename>
+        loader = make_loader("both", json.loads(sys.argv[2]), sys.argv[3])
+        loader.loadtest()
+    else:
+        loader = Loader()
+        loader.loadtest()
+    loader.close()
     print("Load test done.")
@@ -0,0 +1,210 @@
+import os
+import json
+import time
+import glob
+import socket
+import threading
+from records import read_manifest, shard_dirs
+
+# Heartbeats of the jobs writing to the same shard, shared by the loaders of a combined job
+_heartbeats = {}
+
+
+class Heartbeat:
+    """Progress of a job, rewritten to a small json file next to its shard
+    after every run and every interval seconds from a background thread, so
+    that a hung job can be told apart from a dead one."""
+
+    def __init__(self, shard_filename, interval=60):
+        shard_dir, name = os.path.split(shard_filename)
+        self.job = os.path.splitext(name)[0]
+        heartbeat_dir = os.path.join(shard_dir, "heartbeats")
+        os.makedirs(heartbeat_dir, exist_ok=True)
+        self.filename = os.path.join(heartbeat_dir, f"{self.job}.json")
+        self.interval = interval
+        self.lock = threading.Lock()
+        now = time.time()
+        self.state = {
+            "job": self.job,
+            "host": socket.gethostname(),
+            "pid": os.getpid(),
+            "slurm_job_id": os.environ.get("SLURM_JOB_ID"),
+            "started": now,
+            "updated": now,
+            "last_done": now,
+            "runs_total": 0,
+            "runs_done": 0,
+            "runs_ok": 0,
+            "runs_failed": 0,
+            "bytes_read": 0,
+            "finished": False,
+        }
+        self._stop = threading.Event()
+        self._thread = None
+
+    @classmethod
+    def for_shard(cls, shard_filename, interval=60):
+        """Get the heartbeat of the job writing to a shard, creating it if
+        needed."""
+        if shard_filename not in _heartbeats:
+            _heartbeats[shard_filename] = cls(shard_filename, interval)
+        return _heartbeats[shard_filename]
+
+    def start(self, n_runs):
+        """Add runs to the ones the job has to test, and start beating."""
+        with self.lock:
+            self.state["runs_total"] += n_runs
+        self._write()
+        if self._thread is None and self.interval > 0:
+            self._thread = threading.Thread(target=self._beat, daemon=True)
+            self._thread.start()
+
+    def update(self, records):
+        """Count a tested run from its records."""
+        with self.lock:
+            self.state["runs_done"] += 1
+            if all(record["status"] == "ok" for record in records):
+                self.state["runs_ok"] += 1
+            else:
+                self.state["runs_failed"] += 1
+            self.state["bytes_read"] += sum(record.get("bytes_read") or 0 for record in records)
+            self.state["last_done"] = time.time()
+        self._write()
+
+    def finish(self):
+        """Mark the job as finished and stop beating."""
+        self._stop.set()
+        with self.lock:
+            self.state["finished"] = True
+        self._write()
+
+    def _beat(self):
+        while not self._stop.wait(self.interval):
+            self._write()
+
+    def _write(self):
+        """Rewrite the heartbeat file atomically, so that the monitor never
+        reads a partial one."""
+        with self.lock:
+            self.state["updated"] = time.time()
+            tmp = f"{self.filename}.tmp"
+            with open(tmp, "w") as f:
+                json.dump(self.state, f)
+            os.replace(tmp, self.filename)
+
+
+def read_heartbeats(shard_dir):
+    """Read the heartbeats of all jobs of a submission."""
+    heartbeats = []
+    filenames = []
+    for folder in shard_dirs(shard_dir):
+        filenames += sorted(glob.glob(os.path.join(folder, "heartbeats", "*.json")))
+    for filename in filenames:
+        try:
+            with open(filename, "r") as f:
+                heartbeats.append(json.load(f))
+        except (OSError, json.JSONDecodeError):
+            print(f"Cannot read heartbeat {filename}")
+    return heartbeats
+
+
+def progress(shard_dir, dead_after=180, stall_after=1800, now=None):
+    """Aggregate the heartbeats of a submission into its progress,
+    throughput, ETA and the jobs which are dead, with no heartbeat for
+    dead_after seconds, or stalled, with no run tested for stall_after
+    seconds."""
+    now = time.time() if now is None else now
+    heartbeats = read_heartbeats(shard_dir)
+    manifest = read_manifest(shard_dir)
+
+    runs_done = sum(hb["runs_done"] for hb in heartbeats)
+    runs_ok = sum(hb["runs_ok"] for hb in heartbeats)
+    if manifest is not None:
+        runs_total = sum(len(job["runs"]) for job in manifest["jobs"].values())
+        runs_total *= len(manifest["levels"])
+    else:
+        runs_total = sum(hb["runs_total"] for hb in heartbeats)
+
+    running, finished, dead, stalled = [], [], [], []
+    for hb in heartbeats:
+        if hb["finished"]:
+            finished.append(hb)
+        elif now - hb["updated"] > dead_after:
+            dead.append(hb)
+        else:
+            running.append(hb)
+            if now - hb["last_done"] > stall_after:
+                stalled.append(hb)
+    pending = None
+    if manifest is not None:
+        started = {hb["job"] for hb in heartbeats}
+        # Pilots are named differently from the chunks they pull from the queue
+        pending = len([job for job in manifest["jobs"] if job not in started])
+
+    first_start = min((hb["started"] for hb in heartbeats), default=now)
+    elapsed = max(now - first_start, 1e-3)
+    runs_per_hour = runs_done / elapsed * 3600
+    mb_per_s = sum(
+        hb["bytes_read"] / 1e6 / max(hb["updated"] - hb["started"], 1e-3) for hb in running
+    )
+    remaining = max(runs_total - runs_done, 0)
+    return {
+        "runs_total": runs_total,
+        "runs_done": runs_done,
+        "runs_ok": runs_ok,
+        "runs_failed": runs_done - runs_ok,
+        "pass_rate": runs_ok / runs_done if runs_done else None,
+        "runs_per_hour": runs_per_hour,
+        "mb_per_s": mb_per_s,
+        "eta_hours": remaining / runs_per_hour if runs_per_hour else None,
+        "jobs_running": len(running),
+        "jobs_finished": len(finished),
+        "jobs_pending": pending,
+        "dead": dead,
+        "stalled": stalled,
+    }
+
+
+def print_progress(shard_dir, status, now=None):
+    """Print the progress of a submission, one line per dead or stalled
+    job."""
+    now = time.time() if now is None else now
+    print("--------------------")
+    print(f"{time.strftime('%Y-%m-%d %H:%M:%S')} {shard_dir}")
+    print(
+        f"Runs: {status['runs_done']} / {status['runs_total']} tested, "
+        f"{status['runs_ok']} passed, {status['runs_failed']} failed"
+        + (f" ({status['pass_rate']:.1%} pass)" if status["pass_rate"] is not None else "")
+    )
+    print(
+        f"Jobs: {status['jobs_running']} running, {status['jobs_finished']} finished, "
+        f"{len(status['dead'])} dead, {len(status['stalled'])} stalled"
+        + (f", {status['jobs_pending']} not started" if status["jobs_pending"] is not None else "")
+    )
+    eta = f"{status['eta_hours']:.1f} h" if status["eta_hours"] is not None else "unknown"
+    print(
+        f"Throughput: {status['runs_per_hour']:.1f} runs/hour, {status['mb_per_s']:.1f} MB/s, "
+        f"ETA {eta}"
+    )
+    for hb in status["dead"]:
+        print(
+            f"Dead: {hb['job']} on {hb['host']} (slurm job {hb['slurm_job_id']}), "
+            f"no heartbeat for {now - hb['updated']:.0f} s"
+        )
+    for hb in status["stalled"]:
+        print(
+            f"Stalled: {hb['job']} on {hb['host']} (slurm job {hb['slurm_job_id']}), "
+            f"no run tested for {now - hb['last_done']:.0f} s"
+        )
+
+
+def monitor(shard_dir, refresh=0, dead_after=180, stall_after=1800):
+    """Print the progress of a submission, every refresh seconds until all
+    runs are tested if refresh > 0."""
+    while True:
+        status = progress(shard_dir, dead_after, stall_after)
+        print_progress(shard_dir, status)
+        done = status["runs_done"] >= status["runs_total"] and not status["jobs_running"]
+        if refresh <= 0 or done:
+            return status
+        time.sleep(refresh)
@@ -0,0 +1,181 @@
+import os
+import glob
+import heapq
+import numpy as np
+from records import read_records, shard_dirs
+
+# Numbers of runs per job tried for the recommendation
+RUNS_PER_JOB = [1, 2, 5, 10, 20, 50, 100]
+
+
+def history(result_folders, levels):
+    """Wall time in seconds and peak RSS in MB of each run tested in the
+    previous submissions, summed and maxed over its checks, one sample per
+    run and submission."""
+    samples = {}
+    submissions = []
+    for result_folder in sorted(set(result_folders)):
+        submissions += sorted(glob.glob(os.path.join(result_folder, "*-shards")))
+    # The shards of routed jobs are read with the submission they belong to
+    routed = {folder for shard_dir in submissions for folder in shard_dirs(shard_dir)[1:]}
+    for shard_dir in submissions:
+        if shard_dir in routed:
+            continue
+        for record in read_records(shard_dir):
+            # Cached records were not measured
+            if record["level"] not in levels or record.get("time") is None:
+                continue
+            sample = samples.setdefault(
+                (shard_dir, record["run"]), {"run": record["run"], "time": 0.0, "peak_rss": 0.0}
+            )
+            sample["time"] += record["time"]
+            sample["peak_rss"] = max(sample["peak_rss"], record.get("peak_rss") or 0.0)
+    return list(samples.values())
+
+
+def fit(sizes, values, quantile=99):
+    """Fit values as intercept + slope * sizes, with the intercept raised so
+    that the quantile of the samples are below the fit."""
+    sizes = np.asarray(sizes, dtype=float)
+    values = np.asarray(values, dtype=float)
+    if np.ptp(sizes) > 0:
+        slope, intercept = np.polyfit(sizes, values, 1)
+        slope = max(slope, 0.0)
+    else:
+        slope, intercept = 0.0, 0.0
+    residuals = values - (intercept + slope * sizes)
+    return float(intercept + np.percentile(residuals, quantile)), float(slope)
+
+
+def model(sizes, samples, settings):
+    """Model of the peak RSS and wall time of a run from its size in MB,
+    fitted on the samples of runs of known size, or taken from the settings
+    if there are too few of them."""
+    samples = [s for s in samples if sizes.get(s["run"])]
+    result = {"n_samples": len(samples)}
+    if len(samples) < settings["min_history"]:
+        print(f"Only {len(samples)} runs of known size tested before, using the configuration.")
+        result.update(
+            {
+                "ram_overhead": settings["ram_overhead"],
+                "ram_per_mb": settings["ram_per_mb"],
+                "time_overhead": settings["time_overhead"],
+                "time_per_mb": settings["time_per_mb"],
+            }
+        )
+        return result
+    run_sizes = [sizes[s["run"]] for s in samples]
+    result["ram_overhead"], result["ram_per_mb"] = fit(run_sizes, [s["peak_rss"] for s in samples])
+    result["time_overhead"], result["time_per_mb"] = fit(
+        run_sizes, [s["time"] for s in samples], quantile=90
+    )
+    return result
+
+
+def completion_time(job_times, max_num_submit):
+    """Time to run all jobs in order with at most max_num_submit at the same
+    time, each one starting as soon as one ends."""
+    slots = [0.0] * min(max_num_submit, len(job_times))
+    for job_time in job_times:
+        heapq.heappush(slots, heapq.heappop(slots) + job_time)
+    return max(slots, default=0.0)
+
+
+def evaluate(runids, sizes, fitted, settings, runs_per_job):
+    """Predict the memory and wall time of each job of runs_per_job runs,
+    and the cost and completion time of the campaign."""
+    chunks = [runids[i : i + runs_per_job] for i in range(0, len(runids), runs_per_job)]
+    cpus = settings["cpus_per_task"]
+    mems = []
+    times = []
+    for chunk in chunks:
+        largest = max(sizes.get(r, 0.0) for r in chunk)
+        mems.append(fitted["ram_overhead"] + fitted["ram_per_mb"] * largest)
+        run_times = [
+            fitted["time_overhead"] + fitted["time_per_mb"] * sizes.get(r, 0.0) for r in chunk
+        ]
+        # Runs are spread over the workers of the job
+        times.append(settings["job_startup"] + sum(run_times) / cpus)
+    hours = np.array(times) / 3600
+    return {
+        "runs_per_job": runs_per_job,
+        "n_jobs": len(chunks),
+        "max_mem_per_cpu": float(max(mems, default=0.0)),
+        "max_job_hours": float(max(hours, default=0.0)),
+        "core_hours": float(np.sum(hours) * cpus),
+        # Memory allocated with the current memory of the level against the predicted one
+        "allocated_gb_hours": float(np.sum(hours) * cpus * settings["mem_per_cpu"] / 1e3),
+        "needed_gb_hours": float(np.sum(hours * np.array(mems)) * cpus / 1e3),
+        "n_jobs_over_memory": int(sum(mem > settings["mem_per_cpu"] for mem in mems)),
+        "completion_hours": completion_time(list(hours), settings["max_num_submit"]),
+    }
+
+
+def plan(runids, sizes, samples, settings):
+    """Predict the campaign of a runlist with the current settings and with
+    other numbers of runs per job, and recommend the settings finishing
+    first within max_job_hours, with the fewest jobs among equals."""
+    fitted = model(sizes, samples, settings)
+    current = evaluate(runids, sizes, fitted, settings, settings["runs_per_job"])
+    # More runs per job than runs all give the same single job
+    runs_per_job = sorted({min(n, max(len(runids), 1)) for n in RUNS_PER_JOB})
+    candidates = [evaluate(runids, sizes, fitted, settings, n) for n in runs_per_job]
+    feasible = [c for c in candidates if c["max_job_hours"] <= settings["max_job_hours"]]
+    best = min(
+        feasible or candidates,
+        key=lambda c: (round(c["completion_hours"], 1), c["n_jobs"]),
+    )
+    total_mb = sum(sizes.get(r, 0.0) for r in runids)
+    # Round the memory up to the next GB, with some headroom
+    ram = int(np.ceil(best["max_mem_per_cpu"] * 1.1 / 1000) * 1000)
+    recommended = {
+        "runs_per_job": best["runs_per_job"],
+        "mem_per_cpu": ram,
+        "max_num_submit": min(settings["max_num_submit"], best["n_jobs"]),
+        "size_chunking": True,
+        "mb_per_job": round(total_mb / max(best["n_jobs"], 1)),
+        "ram_overhead": int(np.ceil(fitted["ram_overhead"])),
+        "ram_per_mb": round(fitted["ram_per_mb"], 3),
+    }
+    return {
+        "n_runs": len(runids),
+        "total_mb": total_mb,
+        "model": fitted,
+        "current": current,
+        "candidates": candidates,
+        "best": best,
+        "recommended": recommended,
+    }
+
+
+def print_plan(result, ram_options):
+    """Print the predictions of a plan and its recommended settings, the
+    memory as each of ram_options."""
+    print("--------------------")
+    fitted = result["model"]
+    print(
+        f"{result['n_runs']} runs, {result['total_mb']:.0f} MB, model fitted on "
+        f"{fitted['n_samples']} runs: peak RSS = {fitted['ram_overhead']:.0f} MB + "
+        f"{fitted['ram_per_mb']:.3f} x size, time = {fitted['time_overhead']:.1f} s + "
+        f"{fitted['time_per_mb']:.4f} s x size"
+    )
+    for name, c in [("Current", result["current"])] + [
+        (f"{c['runs_per_job']} runs/job", c) for c in result["candidates"]
+    ]:
+        print(
+            f"{name}: {c['n_jobs']} jobs, up to {c['max_mem_per_cpu']:.0f} MB and "
+            f"{c['max_job_hours']:.2f} h per job, {c['core_hours']:.1f} core-hours, "
+            f"{c['needed_gb_hours']:.0f} of {c['allocated_gb_hours']:.0f} GB-hours used, "
+            f"{c['n_jobs_over_memory']} jobs over memory, done in {c['completion_hours']:.2f} h"
+        )
+    print("Recommended settings:")
+    recommended = result["recommended"]
+    print(f"    runs_per_job = {recommended['runs_per_job']}")
+    for option in ram_options:
+        print(f"    {option} = {recommended['mem_per_cpu']}")
+    print(f"    max_num_submit = {recommended['max_num_submit']}")
+    print("    or, to size each job to its runs:")
+    print(f"    size_chunking = {recommended['size_chunking']}")
+    print(f"    mb_per_job = {recommended['mb_per_job']}")
+    print(f"    ram_overhead = {recommended['ram_overhead']}")
+    print(f"    ram_per_mb = {recommended['ram_per_mb']}")
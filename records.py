@@ -0,0 +1,246 @@
+import os
+import re
+import json
+import glob
+import errno
+import numpy as np
+
+# Error categories worth a new attempt, the others need a fix of the data
+RETRYABLE = ["transient", "oom", "killed"]
+
+# Errors of shared filesystems and databases which usually go away by themselves
+_TRANSIENT_ERRNOS = {
+    errno.EIO,
+    errno.EAGAIN,
+    errno.EBUSY,
+    errno.EINTR,
+    errno.ESTALE,
+    errno.ETIMEDOUT,
+    errno.ECONNRESET,
+    errno.ECONNREFUSED,
+}
+
+# Messages of slurm and the kernel when a job is killed for memory
+_OOM_LOG = re.compile(r"oom-kill|OUT_OF_MEMORY|out of memory", re.IGNORECASE)
+
+
+def write_records(filename, records):
+    """Append records to a JSONL shard.
+
+    Each job owns its shard, so no locking is needed.
+    """
+    with open(filename, "a") as f:
+        for record in records:
+            f.write(json.dumps(record) + "\n")
+
+
+def classify_error(error):
+    """Category of an exception raised while checking or loading a run:
+    missing, transient, corruption, oom or other."""
+    name = type(error).__name__
+    message = str(error).lower()
+    if isinstance(error, MemoryError) or "out of memory" in message:
+        return "oom"
+    if isinstance(error, FileNotFoundError) or name == "DataNotAvailable":
+        return "missing"
+    if (
+        isinstance(error, (TimeoutError, ConnectionError, InterruptedError))
+        or (isinstance(error, OSError) and error.errno in _TRANSIENT_ERRNOS)
+        or any(word in name for word in ["Timeout", "Reconnect", "Connection"])
+    ):
+        return "transient"
+    if (
+        isinstance(error, (ValueError, EOFError))
+        # zlib.error and struct.error are both named error
+        or name in ["DataCorrupted", "ZstdError", "LZ4FrameError", "error"]
+        or any(word in message for word in ["corrupt", "decompress", "truncated"])
+    ):
+        return "corruption"
+    return "other"
+
+
+def read_shard(filename):
+    """Read the records of a single shard."""
+    records = []
+    with open(filename, "r") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                # The job might have been killed while writing
+                print(f"Skipping truncated record in {filename}")
+    return records
+
+
+def shard_dirs(shard_dir):
+    """The shard folder of a submission and the ones of its jobs routed to
+    another partition, from its manifest."""
+    dirs = [shard_dir.rstrip("/")]
+    manifest = read_manifest(shard_dir)
+    if manifest is not None:
+        for job in manifest["jobs"].values():
+            if job.get("shard") and os.path.dirname(job["shard"]) not in dirs:
+                dirs.append(os.path.dirname(job["shard"]))
+    return dirs
+
+
+def read_records(shard_dir):
+    """Read the records of all shards of a submission."""
+    records = []
+    for folder in shard_dirs(shard_dir):
+        for filename in sorted(glob.glob(os.path.join(folder, "*.jsonl"))):
+            records += read_shard(filename)
+    return records
+
+
+def summarize_runs(records):
+    """Summarize records run by run into loadability, error messages and
+    error categories."""
+    runs = {}
+    for record in records:
+        # Shared and escalated sampled loads are followed by the records of each targets tuple,
+        # and failed ones by their diagnosis
+        if record["kind"] in ["plan", "sample", "diagnosis"]:
+            continue
+        run = runs.setdefault(record["run"], {"loaded": False, "missing": [], "errors": []})
+        if record["status"] == "missing":
+            run["missing"].append(record["target"])
+        elif record["status"] != "ok":
+            run["errors"].append((record.get("category", "other"), record["error"]))
+        elif record["kind"] == "load":
+            run["loaded"] = True
+
+    summary = {}
+    for runid, run in sorted(runs.items()):
+        errors = []
+        categories = set()
+        if run["missing"]:
+            errors.append(f"{runid} failed because of missing {run['missing']}")
+            categories.add("missing")
+        for category, e in run["errors"]:
+            errors.append(f"{runid} failed ({category}) because of {e}")
+            categories.add(category)
+        summary[runid] = {
+            "loadable": run["loaded"] and not errors,
+            "errors": errors,
+            "categories": sorted(categories),
+        }
+    return summary
+
+
+def read_manifest(shard_dir):
+    """Read the manifest of the jobs of a submission, or None if it has
+    none."""
+    filename = os.path.join(shard_dir, "manifest.json")
+    if not os.path.exists(filename):
+        return None
+    with open(filename, "r") as f:
+        return json.load(f)
+
+
+def killed_records(shard_dir, records):
+    """Records of the runs of the manifest which have no record at all for a
+    level, since their job was killed before writing them, as oom if the
+    slurm log of the job says so."""
+    manifest = read_manifest(shard_dir)
+    if manifest is None:
+        return []
+    tested = {(record["run"], record["level"]) for record in records}
+    killed = []
+    for jobname, job in manifest["jobs"].items():
+        category = "killed"
+        log = job.get("log")
+        if log is not None and os.path.exists(log):
+            with open(log, "r", errors="replace") as f:
+                if _OOM_LOG.search(f.read()):
+                    category = "oom"
+        for runid in job["runs"]:
+            for level in manifest["levels"]:
+                if (runid, level) not in tested:
+                    error = f"job {jobname} ended without testing it"
+                    killed.append(
+                        {
+                            "run": runid,
+                            "level": level,
+                            "kind": "job",
+                            "target": jobname,
+                            "status": "killed",
+                            "error": error,
+                            "category": category,
+                            "time": None,
+                        }
+                    )
+    return killed
+
+
+def retry_runlists(shard_dir):
+    """Runs of a submission which failed only because of retryable errors,
+    split into the ones which ran out of memory and the others."""
+    records = read_records(shard_dir)
+    records += killed_records(shard_dir, records)
+    summary = summarize_runs(records)
+    oom = []
+    others = []
+    for runid, run in summary.items():
+        categories = set(run["categories"])
+        if run["loadable"] or not categories or not categories <= set(RETRYABLE):
+            continue
+        if "oom" in categories:
+            oom.append(runid)
+        else:
+            others.append(runid)
+    return oom, others
+
+
+def collect(shard_dir):
+    """Merge the shards of a submission into the final loadable and error
+    files, next to the shard folder."""
+    shard_dir = shard_dir.rstrip("/")
+    prefix = shard_dir[: -len("-shards")] if shard_dir.endswith("-shards") else shard_dir
+    result_filename = f"{prefix}-loadable.txt"
+    err_filename = f"{prefix}-err.txt"
+
+    records = read_records(shard_dir)
+    records += killed_records(shard_dir, records)
+    # Still write empty files if there is no record at all
+    levels = sorted({record["level"] for record in records}) or [None]
+    for level in levels:
+        # Combined submissions get one pair of files per level
+        if len(levels) > 1:
+            result_filename = f"{prefix}-{level}-loadable.txt"
+            err_filename = f"{prefix}-{level}-err.txt"
+        summary = summarize_runs([r for r in records if r["level"] == level])
+        n_loadable = 0
+        with open(result_filename, "w") as result_f, open(err_filename, "w") as err_f:
+            for runid, run in summary.items():
+                if run["loadable"]:
+                    result_f.write(f"{runid}\n")
+                    n_loadable += 1
+                for error in run["errors"]:
+                    err_f.write(f"{error}\n\n")
+
+        print(f"{level}: {n_loadable} out of {len(summary)} runs are loadable.")
+        categories = {}
+        for run in summary.values():
+            for category in run["categories"]:
+                categories[category] = categories.get(category, 0) + 1
+        if categories:
+            print(f"Failed runs per error category: {categories}")
+        print(f"Result filename: {result_filename}")
+        print(f"Error filename: {err_filename}")
+    diagnoses = [r for r in records if r["kind"] == "diagnosis"]
+    if diagnoses:
+        diagnosis_filename = f"{prefix}-diagnosis.json"
+        with open(diagnosis_filename, "w") as f:
+            json.dump(diagnoses, f, indent=4)
+        n_broken = sum(r["status"] == "broken" for r in diagnoses)
+        print(f"{n_broken} out of {len(diagnoses)} diagnoses localized broken chunks.")
+        print(f"Diagnosis filename: {diagnosis_filename}")
+    coverages = [r["coverage"]["bytes"] for r in records if r.get("coverage")]
+    if coverages:
+        print(
+            f"{len(coverages)} loads were sampled, covering {np.mean(coverages):.1%} of the bytes."
+        )
@@ -0,0 +1,70 @@
+import numpy as np
+from records import read_records
+
+PERCENTILES = [50, 90, 99]
+METRICS = ["time", "bytes_read", "mb_per_s", "peak_rss"]
+
+
+def aggregate(records, key):
+    """Aggregate the metrics of records grouped by key into percentiles."""
+    groups = {}
+    for record in records:
+        # Cached records were not measured
+        if record.get("time") is None:
+            continue
+        groups.setdefault(str(key(record)), []).append(record)
+
+    table = {}
+    for name, group in sorted(groups.items()):
+        row = {"n": len(group), "n_failed": sum(r["status"] != "ok" for r in group)}
+        for metric in METRICS:
+            values = [r[metric] for r in group if r.get(metric) is not None]
+            if not values:
+                continue
+            row[metric] = dict(
+                zip([f"p{p}" for p in PERCENTILES], np.percentile(values, PERCENTILES))
+            )
+            row[metric]["max"] = max(values)
+        table[name] = row
+    return table
+
+
+def print_table(title, table):
+    """Print an aggregated table, one line per group and metric."""
+    print("--------------------")
+    print(title)
+    for name, row in table.items():
+        print(f"{name}: {row['n']} checks, {row['n_failed']} failed")
+        for metric in METRICS:
+            if metric in row:
+                values = ", ".join(f"{k}={v:.4g}" for k, v in row[metric].items())
+                print(f"    {metric}: {values}")
+
+
+def report(shard_dirs, n_slowest=10):
+    """Report the metrics of all records in the shard folders of a campaign
+    per data type, per storage frontend and per run mode."""
+    records = []
+    for shard_dir in shard_dirs:
+        records += read_records(shard_dir)
+    loads = [r for r in records if r["kind"] == "load"]
+    storages = [r for r in records if r["kind"] == "storage"]
+
+    tables = {
+        "Loading per data type": aggregate(loads, key=lambda r: "+".join(r["target"])),
+        "Storage checks per data type": aggregate(storages, key=lambda r: r["target"]),
+        "Storage checks per frontend": aggregate(storages, key=lambda r: r.get("frontend")),
+        "Loading per run mode": aggregate(loads, key=lambda r: r.get("mode")),
+    }
+    for title, table in tables.items():
+        print_table(title, table)
+
+    print("--------------------")
+    print(f"Slowest {n_slowest} loads:")
+    measured = [r for r in loads if r.get("time") is not None]
+    for r in sorted(measured, key=lambda r: r["time"], reverse=True)[:n_slowest]:
+        print(
+            f"{r['run']} {r['target']}: {r['time']} s, {r.get('peak_rss')} MB peak RSS,"
+            f" {r['status']}"
+        )
+    return tables
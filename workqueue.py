@@ -0,0 +1,55 @@
+import os
+import json
+
+
+class WorkQueue:
+    """File-based work queue on shared disk.
+
+    Each item is a json file in todo, claimed by atomically renaming it
+    into claimed, so that several pilots can pull from the same queue
+    without any lock.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.todo_dir = os.path.join(path, "todo")
+        self.claimed_dir = os.path.join(path, "claimed")
+        self.done_dir = os.path.join(path, "done")
+        for folder in [self.todo_dir, self.claimed_dir, self.done_dir]:
+            os.makedirs(folder, exist_ok=True)
+
+    def put(self, items):
+        """Put items into the queue, written aside first so that no pilot
+        claims a partial file."""
+        for i, item in enumerate(items):
+            name = f"{i:06d}.json"
+            tmp = os.path.join(self.path, f".{name}")
+            with open(tmp, "w") as f:
+                json.dump(item, f)
+            os.rename(tmp, os.path.join(self.todo_dir, name))
+
+    def claim(self):
+        """Claim the next item, returning its name and content, or None and
+        None if the queue is empty."""
+        for name in sorted(os.listdir(self.todo_dir)):
+            claimed = os.path.join(self.claimed_dir, name)
+            try:
+                os.rename(os.path.join(self.todo_dir, name), claimed)
+            except FileNotFoundError:
+                # Another pilot was faster
+                continue
+            with open(claimed, "r") as f:
+                return name, json.load(f)
+        return None, None
+
+    def done(self, name):
+        """Mark a claimed item as done."""
+        os.rename(os.path.join(self.claimed_dir, name), os.path.join(self.done_dir, name))
+
+    def counts(self):
+        """Number of items in each state."""
+        return {
+            "todo": len(os.listdir(self.todo_dir)),
+            "claimed": len(os.listdir(self.claimed_dir)),
+            "done": len(os.listdir(self.done_dir)),
+        }